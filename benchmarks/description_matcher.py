@@ -0,0 +1,102 @@
+"""
+Micro-benchmark of the blacklist description matcher on a synthetic board of 1000 cards.
+
+Usage: python benchmarks/description_matcher.py
+
+Compares the previous matcher, which re-parsed every description for every query and removed non-matching cards from
+the list one by one, with trello_api.filter_search_result.
+"""
+from __future__ import annotations
+
+import re
+import sys
+from os import path
+from random import Random
+from timeit import timeit
+from types import SimpleNamespace
+from typing import NamedTuple, Optional
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+import trello_api  # noqa: E402
+
+
+class Platform(NamedTuple):  # Same shape as user_verification.Platform, without importing the flask app
+    platform_type: str
+    value: Optional[str]
+
+
+REGEX_REMOVE_PARENTHESIS = re.compile(r"\(.+\)")
+REGEX_MATCH_FIELD_CONTENT = re.compile(r"(?<=:).+$", re.MULTILINE)
+
+
+def legacy_is_in_description(desc: str, search_query: str):
+    new_desc = re.sub(REGEX_REMOVE_PARENTHESIS, "", desc).splitlines()
+    all_lines = [line for line in new_desc if line]
+    all_lines = map(lambda element: element.strip().replace("\\", "").replace("u/", "").lower(), all_lines)
+    for line in all_lines:
+        if ':' in line:
+            line = re.search(REGEX_MATCH_FIELD_CONTENT, line).group().strip()
+        if search_query.lower() == line:
+            return True
+    return False
+
+
+def legacy_filter_search_result(search_result, search_query):
+    for card in search_result.copy():
+        if card.closed:
+            search_result.remove(card)
+            continue
+        if search_query.platform_type != "Reddit":
+            if search_query.platform_type not in card.name.upper():
+                search_result.remove(card)
+                continue
+        if not legacy_is_in_description(card.desc, search_query.value):
+            search_result.remove(card)
+            continue
+        for label in card.labels:
+            if label.name.lower() == 'scamming':
+                break
+        else:
+            search_result.remove(card)
+    return search_result
+
+
+def synthetic_board(size: int = 1000, seed: int = 76) -> list[SimpleNamespace]:
+    rng = Random(seed)
+    scamming = SimpleNamespace(name="Scamming")
+    other = SimpleNamespace(name="Duping")
+    cards = []
+    for i in range(size):
+        platform = rng.choice(["XB1", "PS4", "PC"])
+        desc = "\n".join([f"Reddit: u/scammer_{i}",
+                          f"{platform} Name: Gamer Tag {i} (old name {i - 1})",
+                          f"Alt: alt\\_account_{i}",
+                          "",
+                          f"Proof: https://imgur.com/a/{i:06d}",
+                          f"Notes: traded {rng.randint(1, 99)} caps and never delivered"])
+        cards.append(SimpleNamespace(name=f"{platform} - scammer_{i}", desc=desc, closed=rng.random() < 0.1,
+                                     labels=[scamming if rng.random() < 0.9 else other]))
+    return cards
+
+
+def main():
+    board = synthetic_board()
+    queries = [Platform("Reddit", "scammer_500"), Platform("XB1", "gamer tag 10"), Platform("PS4", "gamer tag 11"),
+               Platform("PC", "gamer tag 12"), Platform("XB1", "alt_account_13"), Platform("Reddit", "nobody")]
+    for query in queries:
+        assert legacy_filter_search_result(board.copy(), query) == trello_api.filter_search_result(board.copy(), query)
+
+    runs = 20
+    legacy = timeit(lambda: [legacy_filter_search_result(board.copy(), query) for query in queries], number=runs) / runs
+    trello_api.description_identifiers.cache_clear()
+    cold = timeit(lambda: [trello_api.filter_search_result(board.copy(), query) for query in queries], number=1)
+    warm = timeit(lambda: [trello_api.filter_search_result(board.copy(), query) for query in queries], number=runs) / runs
+    print(f"{len(board)} cards x {len(queries)} queries")
+    print(f"legacy matcher:       {legacy * 1000:8.2f} ms")
+    print(f"matcher, cold cache:  {cold * 1000:8.2f} ms ({legacy / cold:.1f}x)")
+    print(f"matcher, warm cache:  {warm * 1000:8.2f} ms ({legacy / warm:.1f}x)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,177 @@
+"""
+Load test of the profile page under gunicorn with sync workers and with gthread workers.
+
+Usage: python benchmarks/load_test.py [--levels 1,8,32,64] [--duration 10] [--latency 0.1] [--workers 2] [--threads 16]
+
+The app runs against local stand-ins of Deta Base and Reddit, where every Reddit response is delayed by --latency
+seconds. The caches are turned off so every request makes its upstream calls. For each serving mode and each concurrency
+level the profile page is requested in a loop by that many clients for --duration seconds, and requests per second, p50
+and p99 latencies are reported.
+"""
+from __future__ import annotations
+
+import argparse
+import http.client
+import json
+import socket
+import subprocess
+import sys
+import tempfile
+from os import environ, makedirs, path
+from threading import Thread
+from time import monotonic, sleep
+
+ROOT = path.dirname(path.dirname(path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from stubs import deta_base, reddit  # noqa: E402
+
+PROFILE_USER = "loadtest_user"
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_stub(server) -> None:
+    Thread(target=server.serve_forever, daemon=True).start()
+
+
+def seed_user(deta_port: int) -> None:
+    conn = http.client.HTTPConnection("127.0.0.1", deta_port)
+    item = {"key": PROFILE_USER, "verification_complete": True, "is_blacklisted": False, "XBOX": "LoadTest", "XBOX_ID": "1"}
+    conn.request("PUT", "/v1/local/fallout_76_db/items", json.dumps({"items": [item]}), {"Content-Type": "application/json"})
+    conn.getresponse().read()
+    conn.close()
+
+
+def start_app(mode: str, port: int, deta_port: int, reddit_port: int, workers: int, threads: int, tmp_dir: str) -> subprocess.Popen:
+    env = environ | {
+        "GUNICORN_BIND": f"127.0.0.1:{port}",
+        "GUNICORN_WORKER_CLASS": mode,
+        "GUNICORN_WORKERS": str(workers),
+        "GUNICORN_THREADS": str(threads if mode == "gthread" else 1),
+        "FLASK_SECRET_KEY": "load_test",
+        "STORAGE_BACKEND": "deta",
+        "DETA_BASE_URL": f"http://127.0.0.1:{deta_port}/v1",
+        "DETA_PROJECT_KEY": "local_key",
+        "REDDIT_URL": f"http://127.0.0.1:{reddit_port}",
+        "REDDIT_OAUTH_URL": f"http://127.0.0.1:{reddit_port}",
+        # stubs/reddit.py grants a token for any credentials, without them praw can't be created
+        "PRAW_CLIENT_ID": "load_test",
+        "PRAW_CLIENT_SECRET": "load_test",
+        "PRAW_USERNAME": "load_test",
+        "PRAW_PASSWORD": "load_test",
+        "CACHE_SQLITE_PATH": "",
+        "USER_CACHE_TTL": "0",
+        "PROFILE_PAGE_TTL": "0",
+        "PROFILE_DISPLAY_NAME_TTL": "0",
+        "PROFILE_PIC_TTL": "0",
+        "PROFILE_REDDIT_KARMA_TTL": "0",
+        "PROFILE_TRADING_KARMA_TTL": "0",
+        "PROFILE_MAX_STALENESS": "0",
+        "FLAIR_INDEX_PATH": path.join(tmp_dir, "flair_index.bin"),
+        "FLAIR_INDEX_REFRESH_INTERVAL": "0",
+        "BLACKLIST_INDEX_PATH": path.join(tmp_dir, "blacklist_index.json"),
+        "BLACKLIST_SYNC_INTERVAL": "0",
+        "JOB_QUEUE_PATH": path.join(tmp_dir, "job_queue.db"),
+    }
+    # logging.conf writes to ./logs
+    makedirs(path.join(ROOT, "logs"), exist_ok=True)
+    app = subprocess.Popen([sys.executable, "-m", "gunicorn", "main:app", "-c", "gunicorn.conf.py"], cwd=ROOT, env=env,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = monotonic() + 30
+    while monotonic() < deadline:
+        try:
+            request_profile(port)
+            return app
+        except OSError:
+            sleep(0.2)
+    app.terminate()
+    raise RuntimeError(f"gunicorn with {mode} workers did not start")
+
+
+def request_profile(port: int) -> int:
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+    try:
+        conn.request("GET", f"/user/{PROFILE_USER}")
+        res = conn.getresponse()
+        res.read()
+        return res.status
+    finally:
+        conn.close()
+
+
+def percentile(values: list[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, round(q * (len(values) - 1)))] if values else 0.0
+
+
+def run_level(port: int, concurrency: int, duration: float) -> dict:
+    latencies: list[float] = []
+    errors = 0
+    deadline = monotonic() + duration
+
+    def client():
+        nonlocal errors
+        while monotonic() < deadline:
+            start = monotonic()
+            try:
+                status = request_profile(port)
+            except OSError:
+                status = None
+            if status == 200:
+                latencies.append(monotonic() - start)
+            else:
+                errors += 1
+
+    clients = [Thread(target=client) for _ in range(concurrency)]
+    start = monotonic()
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+    elapsed = monotonic() - start
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "rps": len(latencies) / elapsed,
+        "p50_ms": percentile(latencies, 0.5) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the profile page with sync and gthread gunicorn workers.")
+    parser.add_argument("--levels", default="1,8,32,64", help="comma separated numbers of concurrent clients")
+    parser.add_argument("--duration", type=float, default=10, help="seconds per concurrency level")
+    parser.add_argument("--latency", type=float, default=0.1, help="seconds every Reddit response is delayed")
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--threads", type=int, default=16, help="threads per worker in gthread mode")
+    parser.add_argument("--modes", default="sync,gthread")
+    args = parser.parse_args()
+
+    deta_port, reddit_port = free_port(), free_port()
+    start_stub(deta_base.serve(deta_port))
+    start_stub(reddit.serve(reddit_port, args.latency))
+    seed_user(deta_port)
+
+    print(f"{'mode':<8} {'clients':>7} {'requests':>8} {'errors':>6} {'req/s':>8} {'p50 ms':>8} {'p99 ms':>8}")
+    for mode in args.modes.split(","):
+        port = free_port()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            app = start_app(mode, port, deta_port, reddit_port, args.workers, args.threads, tmp_dir)
+            try:
+                for concurrency in map(int, args.levels.split(",")):
+                    res = run_level(port, concurrency, args.duration)
+                    print(f"{mode:<8} {concurrency:>7} {res['requests']:>8} {res['errors']:>6} {res['rps']:>8.1f} "
+                          f"{res['p50_ms']:>8.1f} {res['p99_ms']:>8.1f}", flush=True)
+            finally:
+                app.terminate()
+                app.wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,176 @@
+"""
+Local mirror of the two Trello blacklist boards so blacklist checks don't need a live Trello search.
+
+Every card description is normalized once at sync time into the identifiers it lists, and the index maps each identifier
+to the cards that list it. Syncs are incremental: only cards whose dateLastActivity changed are fetched and normalized
+again. Run this module directly to sync once, e.g. from cron.
+"""
+from __future__ import annotations
+
+import json
+from os import getenv, path, replace, stat
+from threading import Lock
+from time import time
+from typing import TYPE_CHECKING, Iterable, NamedTuple, Optional
+
+if __name__ == '__main__':
+    from dotenv import load_dotenv
+
+    # The settings below and those of the imported modules are read on import, the app loads config.env before that
+    load_dotenv('config.env')
+
+import file_refresh
+import metrics
+from log_gen import create_logger
+from trello_api import BLACKLIST_BOARDS, description_identifiers, get_trello_client
+
+if TYPE_CHECKING:
+    from user_verification import Platform
+
+BLACKLIST_INDEX_PATH = getenv('BLACKLIST_INDEX_PATH', "blacklist_index.json")
+BLACKLIST_SYNC_INTERVAL = float(getenv('BLACKLIST_SYNC_INTERVAL', 10 * 60))
+# Once the index is older than this, blacklist checks fall back to a live Trello search
+BLACKLIST_INDEX_MAX_AGE = float(getenv('BLACKLIST_INDEX_MAX_AGE', 60 * 60))
+# Above this many changed cards, the whole board is fetched in one request instead of card by card
+FULL_FETCH_THRESHOLD = 50
+CARD_FIELDS = "name,desc,closed,dateLastActivity,shortUrl,labels"
+
+logger = create_logger(__name__)
+
+
+class BlacklistCard(NamedTuple):
+    id: str
+    name: str
+    short_url: str
+
+
+class BlacklistIndex:
+    """
+    In memory index from normalized identifier to the blacklist cards listing it.
+    """
+
+    def __init__(self, cards: dict[str, dict], synced_at: float):
+        self.cards = cards
+        self.synced_at = synced_at
+        self.identifiers: dict[str, list[str]] = {}
+        for card_id, card in cards.items():
+            for identifier in card["identifiers"]:
+                self.identifiers.setdefault(identifier, []).append(card_id)
+
+    def search(self, search_query: "Platform") -> list[BlacklistCard]:
+        """
+        Finds the cards listing the query with the same filters as trello_api.filter_search_result
+
+        :param search_query: Search Query
+        :return: List of cards containing that query
+        """
+        result = []
+        for card_id in self.identifiers.get(str(search_query.value).lower(), []):
+            card = self.cards[card_id]
+            # closed means the card is archived
+            if card["closed"] or not card["is_scamming"]:
+                continue
+            # Skip cards that are from other platforms
+            if search_query.platform_type != "Reddit" and search_query.platform_type not in card["name"].upper():
+                continue
+            result.append(BlacklistCard(card_id, card["name"], card["short_url"]))
+        return result
+
+    def search_many(self, search_queries: Iterable["Platform"]) -> list[BlacklistCard]:
+        result = set()
+        for query in search_queries:
+            result.update(self.search(query))
+        return list(result)
+
+
+def _card_entry(card: dict) -> dict:
+    return {
+        "name": card["name"],
+        "short_url": card["shortUrl"],
+        "closed": card["closed"],
+        "is_scamming": any(label.get("name", "").lower() == "scamming" for label in card.get("labels", [])),
+        "last_activity": card["dateLastActivity"],
+        "identifiers": sorted(description_identifiers(card.get("desc", ""))),
+    }
+
+
+def _read_cards(file_path: str) -> dict[str, dict]:
+    if not path.exists(file_path):
+        return {}
+    with open(file_path) as fp:
+        return json.load(fp)["cards"]
+
+
+def sync_index(file_path: str = BLACKLIST_INDEX_PATH) -> int:
+    """
+    Brings the local mirror up to date with the blacklist boards.
+
+    :param file_path: Path of the index file
+    :return: Number of cards that were added or changed
+    """
+    trello_client = get_trello_client()
+    old_cards = _read_cards(file_path)
+    cards = {}
+    changed = 0
+    for board in BLACKLIST_BOARDS:
+        activity = trello_client.fetch_json(f"/boards/{board}/cards/all", query_params={"fields": "dateLastActivity"})
+        changed_ids = [card["id"] for card in activity
+                       if card["id"] not in old_cards or old_cards[card["id"]]["last_activity"] != card["dateLastActivity"]]
+        cards.update({card["id"]: old_cards[card["id"]] for card in activity if card["id"] in old_cards})
+        if len(changed_ids) > FULL_FETCH_THRESHOLD:
+            full_cards = trello_client.fetch_json(f"/boards/{board}/cards/all", query_params={"fields": CARD_FIELDS})
+            changed_set = set(changed_ids)
+            full_cards = [card for card in full_cards if card["id"] in changed_set]
+        else:
+            full_cards = [trello_client.fetch_json(f"/cards/{card_id}", query_params={"fields": CARD_FIELDS}) for card_id in changed_ids]
+        for card in full_cards:
+            cards[card["id"]] = _card_entry(card)
+        changed += len(full_cards)
+
+    tmp_path = f"{file_path}.tmp"
+    with open(tmp_path, "w") as fp:
+        json.dump({"synced_at": time(), "cards": cards}, fp)
+    replace(tmp_path, file_path)
+    logger.info(f"Blacklist index synced, {changed} of {len(cards)} cards changed")
+    return changed
+
+
+_index: Optional[BlacklistIndex] = None
+_index_mtime = 0.0
+_index_lock = Lock()
+
+
+def get_index() -> Optional[BlacklistIndex]:
+    """
+    Gets the index, reloading it if the file was synced since it was last loaded.
+
+    :return: BlacklistIndex or None if the index is missing or stale
+    """
+    global _index, _index_mtime
+    try:
+        mtime = stat(BLACKLIST_INDEX_PATH).st_mtime
+    except FileNotFoundError:
+        return None
+    if _index is None or mtime != _index_mtime:
+        with _index_lock:
+            if _index is None or mtime != _index_mtime:
+                with open(BLACKLIST_INDEX_PATH) as fp:
+                    data = json.load(fp)
+                _index = BlacklistIndex(data["cards"], data["synced_at"])
+                _index_mtime = mtime
+    if time() - _index.synced_at > BLACKLIST_INDEX_MAX_AGE:
+        metrics.incr("blacklist_index_stale_total")
+        return None
+    metrics.incr("blacklist_index_hits_total")
+    return _index
+
+
+def start_sync_thread() -> None:
+    """
+    Starts the background thread that keeps the mirror in sync.
+    """
+    file_refresh.start_refresh_thread("blacklist_index", BLACKLIST_INDEX_PATH, BLACKLIST_SYNC_INTERVAL, sync_index)
+
+
+if __name__ == '__main__':
+    sync_index()
@@ -0,0 +1,189 @@
+from __future__ import annotations
+
+import itertools
+import sqlite3
+from collections import OrderedDict
+from os import getenv
+from threading import Lock, local
+from time import monotonic, time, time_ns
+from typing import Any, Optional
+
+import metrics
+
+# When set, caches are kept in this SQLite file so all gunicorn workers share hits and invalidations.
+CACHE_SQLITE_PATH = getenv('CACHE_SQLITE_PATH')
+# Versions of keys not invalidated for this long are pruned, a fetch checking a version must take less time than this
+CACHE_VERSION_RETENTION = 60 * 60
+
+
+class TTLCache:
+    """
+    Thread safe in-process cache that evicts the least recently used entry once full and expires entries after ttl seconds.
+    """
+
+    def __init__(self, name: str, maxsize: int, ttl: float):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict[str, tuple[float, Any]] = OrderedDict()
+        self._versions: dict[str, int] = {}
+        self._version_seq = itertools.count(1)
+        # Keys whose version was forgotten read as the version they were forgotten at, so a check against an older one fails
+        self._version_floor = 0
+        self._lock = Lock()
+
+    def get(self, key: str, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[0] > monotonic():
+                self._data.move_to_end(key)
+                metrics.incr(f"cache_{self.name}_hits_total")
+                return entry[1]
+            if entry is not None:
+                del self._data[key]
+        metrics.incr(f"cache_{self.name}_misses_total")
+        return default
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        with self._lock:
+            self._set(key, value, ttl)
+
+    def _set(self, key: str, value: Any, ttl: Optional[float]) -> None:
+        self._data[key] = (monotonic() + (self.ttl if ttl is None else ttl), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+
+    def version(self, key: str) -> int:
+        with self._lock:
+            return self._versions.get(key, self._version_floor)
+
+    def invalidate(self, key: str) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+            version = next(self._version_seq)
+            if len(self._versions) >= self.maxsize:
+                self._versions.clear()
+                self._version_floor = version
+            self._versions[key] = version
+
+    def set_if_version(self, key: str, value: Any, version: int, ttl: Optional[float] = None) -> bool:
+        with self._lock:
+            if self._versions.get(key, self._version_floor) != version:
+                return False
+            self._set(key, value, ttl)
+            return True
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+
+class SQLiteCache:
+    """
+    Cache stored in a SQLite file so it is shared between processes. Values have to be str, bytes or numbers. Versions are
+    kept in the file too, so an invalidation by one process is seen by the checks of all of them.
+    """
+
+    def __init__(self, name: str, maxsize: int, ttl: float, path: str):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.path = path
+        self._local = local()
+        self._sets = 0
+        with self._connection() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS cache (name TEXT, key TEXT, value, expires_at REAL, PRIMARY KEY (name, key))")
+            conn.execute("CREATE TABLE IF NOT EXISTS versions (name TEXT, key TEXT, version INTEGER NOT NULL, updated_at REAL NOT NULL, "
+                         "PRIMARY KEY (name, key))")
+
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite3 connections can't be shared between threads
+        if getattr(self._local, "conn", None) is None:
+            self._local.conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            self._local.conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn.execute("PRAGMA synchronous=NORMAL")
+        return self._local.conn
+
+    def get(self, key: str, default: Any = None) -> Any:
+        row = self._connection().execute("SELECT value FROM cache WHERE name = ? AND key = ? AND expires_at > ?",
+                                         (self.name, key, time())).fetchone()
+        if row is None:
+            metrics.incr(f"cache_{self.name}_misses_total")
+            return default
+        metrics.incr(f"cache_{self.name}_hits_total")
+        return row[0]
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        conn = self._connection()
+        conn.execute("INSERT OR REPLACE INTO cache (name, key, value, expires_at) VALUES (?, ?, ?, ?)",
+                     (self.name, key, value, time() + (self.ttl if ttl is None else ttl)))
+        self._sets += 1
+        if self._sets % 100 == 0:
+            self._prune(conn)
+
+    def version(self, key: str) -> int:
+        row = self._connection().execute("SELECT version FROM versions WHERE name = ? AND key = ?", (self.name, key)).fetchone()
+        return row[0] if row else 0
+
+    def invalidate(self, key: str) -> None:
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("DELETE FROM cache WHERE name = ? AND key = ?", (self.name, key))
+            # New versions start at the current time, so a key whose version was pruned never gets an old version back
+            conn.execute("INSERT INTO versions (name, key, version, updated_at) VALUES (?, ?, ?, ?) "
+                         "ON CONFLICT (name, key) DO UPDATE SET version = max(version + 1, excluded.version), updated_at = excluded.updated_at",
+                         (self.name, key, time_ns(), time()))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def set_if_version(self, key: str, value: Any, version: int, ttl: Optional[float] = None) -> bool:
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT version FROM versions WHERE name = ? AND key = ?", (self.name, key)).fetchone()
+            is_current = (row[0] if row else 0) == version
+            if is_current:
+                conn.execute("INSERT OR REPLACE INTO cache (name, key, value, expires_at) VALUES (?, ?, ?, ?)",
+                             (self.name, key, value, time() + (self.ttl if ttl is None else ttl)))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return is_current
+
+    def _prune(self, conn: sqlite3.Connection) -> None:
+        conn.execute("DELETE FROM cache WHERE name = ? AND expires_at <= ?", (self.name, time()))
+        # Drops the entries closest to expiry once the cache is over its size
+        conn.execute("DELETE FROM cache WHERE name = ? AND key IN "
+                     "(SELECT key FROM cache WHERE name = ? ORDER BY expires_at DESC LIMIT -1 OFFSET ?)",
+                     (self.name, self.name, self.maxsize))
+        conn.execute("DELETE FROM versions WHERE name = ? AND updated_at < ?", (self.name, time() - CACHE_VERSION_RETENTION))
+
+    def delete(self, key: str) -> None:
+        self._connection().execute("DELETE FROM cache WHERE name = ? AND key = ?", (self.name, key))
+
+    def clear(self) -> None:
+        self._connection().execute("DELETE FROM cache WHERE name = ?", (self.name,))
+
+
+def create_cache(name: str, *, maxsize: int, ttl: float, shared: bool = True) -> TTLCache | SQLiteCache:
+    """
+    Creates a cache, backed by the shared SQLite file if CACHE_SQLITE_PATH is set.
+
+    :param name: Name of the cache, used for metrics and to separate caches in the shared file
+    :param maxsize: Maximum number of entries
+    :param ttl: Default time to live of the entries in seconds
+    :param shared: Whether the cache may use the shared backend. Values of shared caches must be str, bytes or numbers.
+    :return: Cache object
+    """
+    if shared and CACHE_SQLITE_PATH:
+        return SQLiteCache(name, maxsize, ttl, CACHE_SQLITE_PATH)
+    return TTLCache(name, maxsize, ttl)
@@ -0,0 +1,85 @@
+"""
+Circuit breaker that stops calling an upstream for a while after repeated failures, so requests fail fast during an
+outage instead of each waiting for a timeout.
+"""
+from __future__ import annotations
+
+from threading import Lock
+from time import monotonic
+from typing import Any, Callable
+
+import metrics
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised instead of calling the upstream while the circuit is open.
+    """
+
+
+class CircuitBreaker:
+    """
+    Opens after failure_threshold consecutive failures. While open every call is rejected, after reset_timeout seconds
+    one trial call is let through and closes the circuit again if it succeeds.
+    """
+
+    def __init__(self, name: str, *, failure_threshold: int = 5, reset_timeout: float = 30,
+                 failures: tuple[type[BaseException], ...] = (Exception,)):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = failures
+        self._consecutive_failures = 0
+        self._opened_at = None
+        self._trial_running = False
+        self._lock = Lock()
+
+    @property
+    def is_open(self) -> bool:
+        with self._lock:
+            return self._opened_at is not None
+
+    def _before_call(self) -> bool:
+        with self._lock:
+            if self._opened_at is None:
+                return False
+            if self._trial_running or monotonic() - self._opened_at < self.reset_timeout:
+                metrics.incr(f"circuit_breaker_rejected_total{{name=\"{self.name}\"}}")
+                raise CircuitOpenError(f"{self.name} is unavailable")
+            self._trial_running = True
+            return True
+
+    def _after_call(self, is_trial: bool, failed: bool) -> None:
+        with self._lock:
+            if is_trial:
+                self._trial_running = False
+            if not failed:
+                self._consecutive_failures = 0
+                self._opened_at = None
+                return
+            self._consecutive_failures += 1
+            if is_trial or (self._opened_at is None and self._consecutive_failures >= self.failure_threshold):
+                if self._opened_at is None:
+                    metrics.incr(f"circuit_breaker_opened_total{{name=\"{self.name}\"}}")
+                self._opened_at = monotonic()
+
+    def call(self, fn: Callable, *args, **kwargs) -> Any:
+        """
+        Calls fn unless the circuit is open.
+
+        :param fn: Function calling the upstream
+        :return: Result of the call
+        :raises CircuitOpenError: If the circuit is open
+        """
+        is_trial = self._before_call()
+        try:
+            result = fn(*args, **kwargs)
+        except self.failures:
+            self._after_call(is_trial, failed=True)
+            raise
+        except BaseException:
+            # Errors that don't count as failures, e.g. a user that doesn't exist, still show the upstream is up
+            self._after_call(is_trial, failed=False)
+            raise
+        self._after_call(is_trial, failed=False)
+        return result
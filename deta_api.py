@@ -1,23 +1,483 @@
-from os import getenv
+from __future__ import annotations
 
-from deta import Deta
+import json
+from os import getenv, getpid
+from threading import Lock
+from time import perf_counter
+from typing import Callable, Iterator, Optional
+from urllib.parse import quote
+
+import requests
 from deta.base import FetchResponse
+from flask import g, has_request_context, request
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+import cache
+import metrics
+import tracing
+from log_gen import create_logger
+from singleflight import SingleFlight
+from storage import ItemExistsError, ItemNotFoundError, SQLiteBase, StorageBackend
+
+# deta or sqlite
+STORAGE_BACKEND = getenv('STORAGE_BACKEND', "deta")
+SQLITE_DB_PATH = getenv('SQLITE_DB_PATH', "fallout_76_db.sqlite3")
+DETA_BASE_URL = getenv('DETA_BASE_URL', "https://database.deta.sh/v1")
+# Every gunicorn worker is its own process with its own pool, so the pool only has to cover the threads of one worker.
+# The total number of connections to Deta is roughly workers * DETA_POOL_MAXSIZE.
+DETA_POOL_MAXSIZE = int(getenv('DETA_POOL_MAXSIZE', max(4, int(getenv('GUNICORN_THREADS', 1)))))
+DETA_TIMEOUT = float(getenv('DETA_TIMEOUT', 10))
+# Without a shared cache backend other workers can serve a record for up to this long after it was written
+USER_CACHE_TTL = float(getenv('USER_CACHE_TTL', 60))
+USER_CACHE_MAXSIZE = int(getenv('USER_CACHE_MAXSIZE', 1024))
+GAMERTAG_INDEX_BASE = "gamertag_index"
+# Platform fields of a user record, searched in this order when a GamerTag is used on several platforms
+GAMERTAG_FIELDS = ("XBOX", "PlayStation", "Fallout 76")
+# Written to the platform fields by profile.update_user_info when the name can't be fetched, never indexed
+XBOX_GAMERTAG_PLACEHOLDER = "Failed to fetch the XBOX GamerTag."
+PSN_GAMERTAG_PLACEHOLDER = "Failed to fetch the PSN GamerTag."
+GAMERTAG_PLACEHOLDERS = frozenset({XBOX_GAMERTAG_PLACEHOLDER, PSN_GAMERTAG_PLACEHOLDER})
+
+logger = create_logger(__name__)
+
+
+class _TimedHTTPConnection(HTTPConnection):
+    def connect(self):
+        start = perf_counter()
+        super().connect()
+        metrics.incr("deta_connections_total")
+        metrics.incr("deta_connect_seconds_total", perf_counter() - start)
+
+
+class _TimedHTTPSConnection(HTTPSConnection):
+    def connect(self):
+        start = perf_counter()
+        super().connect()
+        metrics.incr("deta_connections_total")
+        metrics.incr("deta_connect_seconds_total", perf_counter() - start)
+
+
+class _TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _TimedHTTPConnection
+
+
+class _TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _TimedHTTPSConnection
+
+
+class _TimedHTTPAdapter(tracing.TracedHTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {"http": _TimedHTTPConnectionPool, "https": _TimedHTTPSConnectionPool}
+
+
+class DetaBase(StorageBackend):
+    """
+    Minimal client for the Deta Base HTTP API that keeps its connections alive between calls.
+    """
+
+    def __init__(self, name: str, project_key: str, *, base_url: str = DETA_BASE_URL, pool_maxsize: int = DETA_POOL_MAXSIZE):
+        project_id = project_key.split("_")[0]
+        self.url = f"{base_url.rstrip('/')}/{project_id}/{name}"
+        self.session = requests.Session()
+        self.session.headers.update({"X-API-Key": project_key, "Content-Type": "application/json"})
+        adapter = _TimedHTTPAdapter("deta", pool_connections=1, pool_maxsize=pool_maxsize)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def _request(self, method: str, path: str, **kwargs) -> requests.Response:
+        metrics.incr("deta_requests_total")
+        res = self.session.request(method, f"{self.url}{path}", timeout=DETA_TIMEOUT, **kwargs)
+        return res
+
+    def get(self, key: str) -> Optional[dict]:
+        """
+        Gets a single item by its key
+
+        :param key: Key of the item
+        :return: The item or None if it doesn't exist
+        :raises HTTPError: If an HTTP Error occurs
+        """
+        res = self._request("GET", f"/items/{quote(key, safe='')}")
+        if res.status_code == 404:
+            return None
+        res.raise_for_status()
+        return res.json()
+
+    def fetch(self, query: dict | list, *, limit: int = 1000, last: Optional[str] = None) -> FetchResponse:
+        """
+        Fetches the items matching the query
+
+        :param query: Deta Base query
+        :param limit: Maximum number of items in one page
+        :param last: Key of the last item of the previous page
+        :return: FetchResponse with the items
+        :raises HTTPError: If an HTTP Error occurs
+        """
+        payload = {"query": query if isinstance(query, list) else [query], "limit": limit}
+        if last:
+            payload["last"] = last
+        res = self._request("POST", "/query", json=payload)
+        res.raise_for_status()
+        json_data = res.json()
+        paging = json_data.get("paging", {})
+        return FetchResponse(paging.get("size", 0), paging.get("last"), json_data.get("items", []))
+
+    def insert(self, data: dict) -> dict:
+        """
+        Inserts an item, fails if an item with the same key already exists
+
+        :param data: Item to insert
+        :return: The inserted item
+        :raises ItemExistsError: If an item with the same key already exists
+        :raises HTTPError: If an HTTP Error occurs
+        """
+        res = self._request("POST", "/items", json={"item": data})
+        if res.status_code == 409:
+            raise ItemExistsError(data["key"])
+        res.raise_for_status()
+        return res.json()
+
+    def put(self, data: dict, key: Optional[str] = None) -> dict:
+        """
+        Inserts or overwrites an item
+
+        :param data: Item to store
+        :param key: Key of the item, takes precedence over the key in data
+        :return: The stored item
+        :raises HTTPError: If an HTTP Error occurs
+        """
+        item = data | {"key": key} if key else data
+        res = self._request("PUT", "/items", json={"items": [item]})
+        res.raise_for_status()
+        return res.json().get("processed", {}).get("items", [item])[0]
+
+    def update(self, key: str, set_fields: dict) -> None:
+        """
+        Sets some fields of an existing item without touching the others
+
+        :param key: Key of the item
+        :param set_fields: Fields to set
+        :raises ItemNotFoundError: If the item doesn't exist
+        :raises HTTPError: If an HTTP Error occurs
+        """
+        res = self._request("PATCH", f"/items/{quote(key, safe='')}", json={"set": set_fields})
+        if res.status_code == 404:
+            raise ItemNotFoundError(key)
+        res.raise_for_status()
+
+    def put_many(self, items: list[dict]) -> None:
+        """
+        Inserts or overwrites the items, 25 items per request which is the limit of Deta Base
+
+        :param items: Items to store, each with its key
+        :raises HTTPError: If an HTTP Error occurs
+        """
+        for i in range(0, len(items), 25):
+            res = self._request("PUT", "/items", json={"items": items[i:i + 25]})
+            res.raise_for_status()
+
+    def delete(self, key: str) -> None:
+        """
+        Deletes an item, does nothing if it doesn't exist
+
+        :param key: Key of the item
+        :raises HTTPError: If an HTTP Error occurs
+        """
+        res = self._request("DELETE", f"/items/{quote(key, safe='')}")
+        res.raise_for_status()
+
+
+_bases: dict[str, StorageBackend] = {}
+_bases_pid: Optional[int] = None
+_bases_lock = Lock()
+
+
+def create_base(name: str, backend: str = STORAGE_BACKEND) -> StorageBackend:
+    """
+    Creates a client for a base of the given storage backend.
+
+    :param name: Name of the base
+    :param backend: deta or sqlite
+    :return: StorageBackend
+    """
+    if backend == "sqlite":
+        return SQLiteBase(name, SQLITE_DB_PATH)
+    elif backend == "deta":
+        return DetaBase(name, getenv('DETA_PROJECT_KEY'))
+    else:
+        raise ValueError(f"Unknown storage backend {backend}")
+
+
+def get_base(name: str = "fallout_76_db") -> StorageBackend:
+    """
+    Gets the client of this worker process, creating it on first use. Forked workers get their own client so sockets are
+    never shared between processes.
+
+    :param name: Name of the base
+    :return: StorageBackend client for the base
+    """
+    global _bases_pid
+    if _bases_pid != getpid() or name not in _bases:
+        with _bases_lock:
+            if _bases_pid != getpid():
+                _bases.clear()
+                _bases_pid = getpid()
+            if name not in _bases:
+                _bases[name] = create_base(name)
+    return _bases[name]
+
+
+def pool_stats() -> dict[str, float]:
+    """
+    Connection pool stats of this worker process. Every request that did not open a connection reused a pooled one.
+
+    :return: Dict with number of requests, new connections, pool hits and time spent connecting
+    """
+    requests_total = metrics.get("deta_requests_total")
+    connections_total = metrics.get("deta_connections_total")
+    return {"requests": requests_total,
+            "connections": connections_total,
+            "pool_hits": requests_total - connections_total,
+            "connect_seconds": metrics.get("deta_connect_seconds_total")}
+
+
+_user_cache = cache.create_cache("users", maxsize=USER_CACHE_MAXSIZE, ttl=USER_CACHE_TTL)
+_user_flight = SingleFlight("deta_get")
+
+
+class UnitOfWork:
+    """
+    Collects the field changes made to records during a request so each record is written once when the request ends.
+    Also remembers the records read during the request so handlers reading the same record again don't fetch it again.
+    """
+
+    def __init__(self):
+        self.changes: dict[str, dict] = {}
+        self.loaded: dict[str, str] = {}
+
+    def update(self, key: str, fields: dict) -> None:
+        self.changes.setdefault(key.lower(), {}).update(fields)
+
+    def flush(self) -> None:
+        changes, self.changes = self.changes, {}
+        for key, fields in changes.items():
+            try:
+                update_fields(key, fields)
+            except ItemNotFoundError:
+                logger.warning(f"Dropped the changes to {key} since the record doesn't exist anymore")
+
+
+def _count_write(writes: int = 1, metric: str = "deta_writes_total") -> None:
+    endpoint = request.endpoint if has_request_context() else "background"
+    metrics.incr(f"{metric}{{endpoint=\"{endpoint}\"}}", writes)
+
+
+def unit_of_work() -> Optional[UnitOfWork]:
+    """
+    Gets the unit of work of the current request.
+
+    :return: UnitOfWork or None outside of a request
+    """
+    if not has_request_context():
+        return None
+    if "deta_unit_of_work" not in g:
+        g.deta_unit_of_work = UnitOfWork()
+    return g.deta_unit_of_work
+
+
+def flush_unit_of_work(error: Optional[BaseException] = None) -> None:
+    """
+    Writes the changes collected during the request. Registered as a teardown function of the app.
+
+    :param error: Exception that ended the request, if any
+    """
+    if (uow := g.pop("deta_unit_of_work", None)) is not None:
+        uow.flush()
 
 
 def get_item(key: str) -> FetchResponse:
-    deta = Deta(getenv('DETA_PROJECT_KEY'))
-    fallout_76_db = deta.Base("fallout_76_db")
-    fetch_res = fallout_76_db.fetch({"key": key})
+    """
+    Gets the user record, served from the cache if it was fetched recently. Changes made earlier in the same request
+    that haven't been written yet are applied to the record.
+
+    :param key: Reddit username
+    :return: FetchResponse with the user record, empty if the user doesn't exist
+    """
+    key = key.lower()
+    uow = unit_of_work()
+    # Items are cached as json so every caller gets its own copy to modify
+    if uow is not None and key in uow.loaded:
+        cached = uow.loaded[key]
+    elif (cached := _user_cache.get(key)) is None:
+        # Concurrent requests for the same record share one fetch
+        cached = _user_flight.do(key, _load_item, key)
+    if uow is not None:
+        uow.loaded[key] = cached
+    items = json.loads(cached)
+    fetch_res = FetchResponse(len(items), None, items)
+    if fetch_res.count and uow is not None and key in uow.changes:
+        fetch_res.items[0] |= uow.changes[key]
     return fetch_res
 
 
+def _load_item(key: str) -> str:
+    # Every write bumps the version of the record in the cache, also in the shared cache file of all the workers
+    version = _user_cache.version(key)
+    item = get_base().get(key)
+    cached = json.dumps([item] if item else [])
+    # A write during the fetch already dropped the cached record, caching what was read before it would bring it back.
+    # The flight is forgotten too, so callers arriving from now on fetch the written record instead of joining this one.
+    if not _user_cache.set_if_version(key, cached, version):
+        _user_flight.forget(key)
+    return cached
+
+
+def normalize_gamer_tag(gamer_tag: str) -> str:
+    return " ".join(gamer_tag.split()).casefold()
+
+
+def _gamer_tag_entries(key: str, fields: dict, previous: Optional[dict] = None) -> list[dict]:
+    """
+    Index entries pointing at the user for every GamerTag in the written fields. GamerTags the previous version of the
+    record already had are skipped since their entries exist.
+    """
+    entries = []
+    for platform in GAMERTAG_FIELDS:
+        if not (gamer_tag := fields.get(platform)) or gamer_tag in GAMERTAG_PLACEHOLDERS:
+            continue
+        normalized = normalize_gamer_tag(str(gamer_tag))
+        if previous is not None and normalize_gamer_tag(str(previous.get(platform, ""))) == normalized:
+            continue
+        entries.append({"key": f"gt:{platform}:{normalized}", "username": key})
+    return entries
+
+
+def _index_gamer_tags(key: str, fields: dict, previous: Optional[dict] = None) -> None:
+    """
+    Points the secondary index at the user for every changed GamerTag in the written fields. Every entry belongs to one
+    platform and is written without reading it first, so concurrent writers can't lose each other's entries. Entries for
+    names the user doesn't have anymore are left behind, skipped by lookups and overwritten once another user verifies
+    the name.
+    """
+    if entries := _gamer_tag_entries(key, fields, previous):
+        get_base(GAMERTAG_INDEX_BASE).put_many(entries)
+        # Counted apart from the writes of user records, which deta_writes_total tracks
+        _count_write((len(entries) + 24) // 25, "deta_index_writes_total")
+
+
+def find_user_by_gamer_tag(gamer_tag: str) -> Optional[str]:
+    """
+    Finds the user that verified a GamerTag on any platform with a single index query.
+
+    :param gamer_tag: XBOX, PlayStation or PC GamerTag
+    :return: Reddit username or None if no user has that GamerTag
+    """
+    if gamer_tag in GAMERTAG_PLACEHOLDERS:
+        return None
+    normalized = normalize_gamer_tag(gamer_tag)
+    query = [{"key": f"gt:{platform}:{normalized}"} for platform in GAMERTAG_FIELDS]
+    owners = {entry["key"]: entry["username"] for entry in get_base(GAMERTAG_INDEX_BASE).fetch(query).items}
+    for platform in GAMERTAG_FIELDS:
+        if (username := owners.get(f"gt:{platform}:{normalized}")) is None:
+            continue
+        fetch_res = get_item(username)
+        # The entry is stale if the user changed the GamerTag since it was indexed
+        if fetch_res.count and normalize_gamer_tag(str(fetch_res.items[0].get(platform, ""))) == normalized:
+            return username
+    return None
+
+
+_write_listeners: list[Callable[[str], None]] = []
+
+
+def add_write_listener(listener: Callable[[str], None]) -> None:
+    """
+    Registers a function that is called with the key of every user record written, e.g. to invalidate caches.
+
+    :param listener: Function taking the key
+    """
+    _write_listeners.append(listener)
+
+
+def _after_write(key: str, fields: dict) -> None:
+    # The record as it was before the write, if this worker has it, so unchanged GamerTags aren't indexed again
+    previous = None
+    if any(platform in fields for platform in GAMERTAG_FIELDS):
+        uow = g.get("deta_unit_of_work") if has_request_context() else None
+        if (cached := uow.loaded.get(key) if uow is not None else None) is None:
+            cached = _user_cache.get(key)
+        if cached is not None and (items := json.loads(cached)):
+            previous = items[0]
+    _user_cache.invalidate(key)
+    # A fetch that started before the write could return the old record
+    _user_flight.forget(key)
+    if has_request_context() and (uow := g.get("deta_unit_of_work")) is not None:
+        uow.loaded.pop(key, None)
+    _index_gamer_tags(key, fields, previous)
+    for listener in _write_listeners:
+        listener(key)
+
+
 def insert_item(data: dict):
-    deta = Deta(getenv('DETA_PROJECT_KEY'))
-    fallout_76_db = deta.Base("fallout_76_db")
-    fallout_76_db.insert(data)
+    get_base().insert(data)
+    _count_write()
+    _after_write(data["key"].lower(), data)
 
 
 def update_item(data: dict, key: str):
-    deta = Deta(getenv('DETA_PROJECT_KEY'))
-    fallout_76_db = deta.Base("fallout_76_db")
-    fallout_76_db.put(data, key)
+    get_base().put(data, key)
+    _count_write()
+    _after_write(key.lower(), data)
+
+
+def update_fields(key: str, fields: dict):
+    """
+    Sets some fields of a record without overwriting the rest, so concurrent writers of other fields aren't lost.
+
+    :param key: Reddit username
+    :param fields: Fields to set
+    """
+    get_base().update(key, fields)
+    _count_write()
+    _after_write(key.lower(), fields)
+
+
+def stage_update(key: str, fields: dict):
+    """
+    Sets some fields of a record. Inside a request the change is written once when the request ends, merged with the
+    other changes to the same record, outside of a request it is written right away.
+
+    :param key: Reddit username
+    :param fields: Fields to set
+    """
+    if (uow := unit_of_work()) is not None:
+        uow.update(key, fields)
+    else:
+        update_fields(key, fields)
+
+
+def iter_items(page_size: int = 1000) -> Iterator[dict]:
+    """
+    Streams all the user records page by page, bypassing the cache.
+
+    :param page_size: Number of records fetched per request
+    :return: Iterator over the records
+    """
+    return get_base().iter_items(page_size)
+
+
+def rebuild_gamer_tag_index() -> int:
+    """
+    Indexes the GamerTags of every record, for records written before the index existed.
+
+    :return: Number of records indexed
+    """
+    count = 0
+    entries = []
+    for item in iter_items():
+        entries += _gamer_tag_entries(item["key"], item)
+        count += 1
+    get_base(GAMERTAG_INDEX_BASE).put_many(entries)
+    return count
@@ -0,0 +1,103 @@
+from __future__ import annotations
+
+from os import getenv
+from threading import Lock
+from time import sleep
+from typing import Optional
+
+import requests
+
+import metrics
+import tracing
+from log_gen import create_logger
+
+DISCORD_CONTENT_LIMIT = 2000
+# Messages queued within this many seconds of each other are sent as one webhook message
+DISCORD_COALESCE_WINDOW = float(getenv('DISCORD_COALESCE_WINDOW', 2))
+# Most messages handed to one webhook call, so a failed call retries at most this many
+DISCORD_BATCH_SIZE = int(getenv('DISCORD_BATCH_SIZE', 20))
+DISCORD_MAX_RETRIES = 5
+
+logger = create_logger(__name__)
+
+
+def pack_messages(messages: list[str], limit: int = DISCORD_CONTENT_LIMIT) -> list[str]:
+    """
+    Joins the messages into as few contents as possible without going over the content limit of discord.
+    Messages that are over the limit on their own are split.
+
+    :param messages: Messages to send
+    :param limit: Maximum length of one content
+    :return: List of contents
+    """
+    contents = []
+    current = ""
+    for msg in messages:
+        chunks = [msg[i:i + limit] for i in range(0, len(msg), limit)] or [""]
+        for chunk in chunks:
+            if current and len(current) + 2 + len(chunk) <= limit:
+                current = f"{current}\n\n{chunk}"
+            else:
+                if current:
+                    contents.append(current)
+                current = chunk
+    if current:
+        contents.append(current)
+    return contents
+
+
+class DiscordWebhook:
+    """
+    Sends messages to a discord channel, packed into as few webhook calls as possible, and waits out rate limits.
+    """
+
+    def __init__(self, webhook_url: Optional[str], *, username: str = "User Verification"):
+        self.webhook_url = webhook_url
+        self.username = username
+        self.session = requests.Session()
+        self.session.mount("https://", tracing.TracedHTTPAdapter("discord"))
+        self._send_lock = Lock()
+
+    def send(self, messages: list[str]) -> None:
+        """
+        Sends the messages. Contents discord rejects are dropped.
+
+        :param messages: message contents
+        :raises requests.RequestException: If discord could not be reached or kept failing, so the caller retries. The
+                                           contents sent before the failure are sent again by the retry.
+        """
+        metrics.incr("discord_messages_submitted_total", len(messages))
+        contents = pack_messages(messages)
+        metrics.incr("discord_messages_coalesced_total", max(len(messages) - len(contents), 0))
+        # One batch at a time so a rate limit pauses every batch of this process
+        with self._send_lock:
+            for content in contents:
+                if self._post(content):
+                    metrics.incr("discord_payloads_sent_total")
+                else:
+                    metrics.incr("discord_payloads_dropped_total")
+
+    def _post(self, content: str) -> bool:
+        if not self.webhook_url:
+            logger.warning("No discord webhook url is set, the message is dropped")
+            return False
+        for _ in range(DISCORD_MAX_RETRIES):
+            res = self.session.post(self.webhook_url, json={"content": content, "username": self.username}, timeout=10)
+            if res.status_code == 429:
+                metrics.incr("discord_rate_limited_total")
+                retry_after = res.headers.get("Retry-After")
+                if retry_after is None:
+                    retry_after = res.json().get("retry_after", 1)
+                sleep(float(retry_after))
+                continue
+            if res.ok:
+                return True
+            # Server errors are retried by the caller, anything else won't be accepted on a retry either
+            if res.status_code >= 500:
+                res.raise_for_status()
+            logger.error(f"Discord webhook returned {res.status_code} {res.text}")
+            return False
+        raise requests.HTTPError(f"Discord webhook still rate limited after {DISCORD_MAX_RETRIES} attempts")
+
+
+webhook = DiscordWebhook(getenv("USER_VERIFICATION_CHANNEL"))
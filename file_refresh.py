@@ -0,0 +1,52 @@
+"""
+Keeps a file that all gunicorn workers read, e.g. the flair index or the blacklist mirror, rebuilt in the background.
+
+Every worker runs the refresh loop, but only the worker holding the lock file next to the file rebuilds it, once it is
+older than the refresh interval.
+"""
+from __future__ import annotations
+
+import fcntl
+from os import path
+from threading import Thread
+from time import sleep, time
+from typing import Callable
+
+from log_gen import create_logger
+
+logger = create_logger(__name__)
+
+
+def _is_due(file_path: str, interval: float) -> bool:
+    return not path.exists(file_path) or time() - path.getmtime(file_path) >= interval
+
+
+def _refresh_loop(file_path: str, interval: float, refresh: Callable[[], object]) -> None:
+    while True:
+        try:
+            if _is_due(file_path, interval):
+                with open(f"{file_path}.lock", "w") as lock_file:
+                    try:
+                        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except BlockingIOError:
+                        pass
+                    else:
+                        # Another worker may have rebuilt it right before the lock was released
+                        if _is_due(file_path, interval):
+                            refresh()
+        except Exception as e:
+            logger.exception(f"Refreshing {file_path} failed: {e}", exc_info=True)
+        sleep(min(interval, 60))
+
+
+def start_refresh_thread(name: str, file_path: str, interval: float, refresh: Callable[[], object]) -> None:
+    """
+    Starts the background thread that rebuilds the file with refresh whenever it is older than interval seconds.
+
+    :param name: Name of the thread
+    :param file_path: Path of the file
+    :param interval: Seconds between rebuilds, 0 to never rebuild it
+    :param refresh: Function that rebuilds the file
+    """
+    if interval > 0:
+        Thread(target=_refresh_loop, args=(file_path, interval, refresh), name=name, daemon=True).start()
@@ -0,0 +1,178 @@
+"""
+Snapshot of all user flairs of r/Fallout76Marketplace so trading karma can be looked up without calling reddit.
+
+The index file is a header followed by fixed size records sorted by username, so it can be memory mapped and binary
+searched without loading it. Run this module directly to build the index once, e.g. from cron.
+"""
+from __future__ import annotations
+
+import mmap
+import re
+import struct
+from os import getenv, replace, stat
+from threading import Lock
+from time import time
+from typing import Iterable, Optional
+
+if __name__ == '__main__':
+    from dotenv import load_dotenv
+
+    # The settings below and those of the imported modules are read on import, the app loads config.env before that
+    load_dotenv('config.env')
+
+import file_refresh
+import metrics
+from log_gen import create_logger
+
+FLAIR_INDEX_PATH = getenv('FLAIR_INDEX_PATH', "flair_index.bin")
+FLAIR_INDEX_REFRESH_INTERVAL = float(getenv('FLAIR_INDEX_REFRESH_INTERVAL', 60 * 60))
+# Once the index is older than this, lookups fall back to a live flair request
+FLAIR_INDEX_MAX_AGE = float(getenv('FLAIR_INDEX_MAX_AGE', 3 * 60 * 60))
+
+REGEX_TRADING_KARMA = re.compile(r"(?<=: )\d+\b")
+HEADER = struct.Struct("<4sId")  # magic, number of records, build timestamp
+RECORD = struct.Struct("<20s12s")  # reddit usernames are at most 20 characters
+MAGIC = b"FLR1"
+
+logger = create_logger(__name__)
+
+
+def parse_trading_karma(flair_text: Optional[str]) -> str:
+    """
+    Extracts the trading karma from flair text
+
+    :param flair_text: Flair text of the user
+    :return: Trading Karma of the user
+    """
+    if not flair_text:
+        return "0"
+    else:
+        if res := REGEX_TRADING_KARMA.search(flair_text):
+            return res.group()
+        else:
+            return flair_text.split(' ')[-1]
+
+
+def write_index(flairs: Iterable[tuple[str, Optional[str]]], file_path: str = FLAIR_INDEX_PATH) -> int:
+    """
+    Writes the index file atomically so readers never see a half written index.
+
+    :param flairs: Pairs of username and flair text
+    :param file_path: Path of the index file
+    :return: Number of users in the index
+    """
+    records = {}
+    for username, flair_text in flairs:
+        name = username.lower().encode()
+        karma = parse_trading_karma(flair_text).encode()
+        if len(name) <= 20:
+            # Karma that doesn't fit is stored empty so it is looked up live
+            records[name] = karma if len(karma) <= 12 else b""
+    tmp_path = f"{file_path}.tmp"
+    with open(tmp_path, "wb") as fp:
+        fp.write(HEADER.pack(MAGIC, len(records), time()))
+        for name in sorted(records):
+            fp.write(RECORD.pack(name, records[name]))
+    replace(tmp_path, file_path)
+    return len(records)
+
+
+class FlairIndex:
+    """
+    Read only view of an index file.
+    """
+
+    def __init__(self, file_path: str):
+        with open(file_path, "rb") as fp:
+            self._mmap = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count, self.built_at = HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{file_path} is not a flair index")
+
+    def _name_at(self, i: int) -> bytes:
+        return self._mmap[HEADER.size + i * RECORD.size: HEADER.size + i * RECORD.size + 20].rstrip(b"\0")
+
+    def get(self, username: str) -> Optional[str]:
+        """
+        Binary searches the index for the user
+
+        :param username: Reddit username
+        :return: Trading karma, empty if it has to be looked up live or None if the user has no flair
+        """
+        name = username.lower().encode()
+        low, high = 0, self.count
+        while low < high:
+            mid = (low + high) // 2
+            if self._name_at(mid) < name:
+                low = mid + 1
+            else:
+                high = mid
+        if low < self.count and self._name_at(low) == name:
+            _, karma = RECORD.unpack_from(self._mmap, HEADER.size + low * RECORD.size)
+            return karma.rstrip(b"\0").decode()
+        return None
+
+
+_index: Optional[FlairIndex] = None
+_index_mtime = 0.0
+_index_lock = Lock()
+
+
+def _load_index() -> Optional[FlairIndex]:
+    global _index, _index_mtime
+    try:
+        mtime = stat(FLAIR_INDEX_PATH).st_mtime
+    except FileNotFoundError:
+        return None
+    if _index is None or mtime != _index_mtime:
+        with _index_lock:
+            if _index is None or mtime != _index_mtime:
+                _index = FlairIndex(FLAIR_INDEX_PATH)
+                _index_mtime = mtime
+    return _index
+
+
+def lookup_trading_karma(username: str) -> Optional[str]:
+    """
+    Looks up the trading karma in the index.
+
+    :param username: Reddit username
+    :return: Trading karma, or None if the index is missing or stale and a live lookup is needed
+    """
+    index = _load_index()
+    if index is None or time() - index.built_at > FLAIR_INDEX_MAX_AGE:
+        metrics.incr("flair_index_stale_total")
+        return None
+    karma = index.get(username)
+    if karma == "":
+        return None
+    metrics.incr("flair_index_hits_total")
+    return "0" if karma is None else karma
+
+
+def refresh_index() -> int:
+    """
+    Walks the whole flair list of the subreddit and rewrites the index.
+
+    :return: Number of users in the index
+    """
+    from reddit_api import create_praw_reddit
+
+    # Paging through the whole list takes a while, so it uses its own instance instead of holding up the shared one
+    subreddit = create_praw_reddit().subreddit("Fallout76Marketplace")
+    # praw pages through the flair list, fetching up to 1000 flairs per request
+    flairs = ((flair['user'].name, flair.get('flair_text')) for flair in subreddit.flair(limit=None))
+    count = write_index(flairs)
+    logger.info(f"Flair index rebuilt with {count} users")
+    return count
+
+
+def start_refresh_thread() -> None:
+    """
+    Starts the background thread that keeps the index fresh.
+    """
+    file_refresh.start_refresh_thread("flair_index", FLAIR_INDEX_PATH, FLAIR_INDEX_REFRESH_INTERVAL, refresh_index)
+
+
+if __name__ == '__main__':
+    refresh_index()
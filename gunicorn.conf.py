@@ -1,4 +1,40 @@
 import multiprocessing
+import shutil
+import tempfile
+from os import environ, getenv
 
-bind = "127.0.0.1:8000"
-workers = multiprocessing.cpu_count()
+bind = getenv('GUNICORN_BIND', "127.0.0.1:8000")
+workers = int(getenv('GUNICORN_WORKERS', multiprocessing.cpu_count()))
+# sync serves one request per worker at a time, so a slow upstream call blocks the whole worker. gthread serves `threads`
+# requests per worker concurrently, the outbound clients are shared by the threads and their pools sized from
+# GUNICORN_THREADS.
+worker_class = getenv('GUNICORN_WORKER_CLASS', "sync")
+threads = int(getenv('GUNICORN_THREADS', 16 if worker_class == "gthread" else 1))
+# The app modules size their connection pools from this when they are imported in the workers
+raw_env = [f"GUNICORN_THREADS={threads}"]
+
+
+def on_starting(server):
+    from dotenv import load_dotenv
+    load_dotenv('config.env')
+    # The workers share their counters through METRICS_DIR, without it /metrics only shows the worker serving it
+    if not environ.get('METRICS_DIR'):
+        environ['METRICS_DIR'] = server.metrics_tmp_dir = tempfile.mkdtemp(prefix="metrics-")
+    import metrics
+    # Counters written by the workers of a previous run would otherwise be added to the new ones
+    metrics.clear_snapshots()
+
+
+def on_exit(server):
+    if tmp_dir := getattr(server, "metrics_tmp_dir", None):
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def post_worker_init(worker):
+    # A HUP to the master restarts the workers, which also reloads the roles. A HUP sent to a single worker only reloads
+    # its roles.
+    import roles
+    roles.install_sighup_handler()
+    # main starts the job workers on import, this covers a preloaded app whose import ran in the master
+    import job_queue
+    job_queue.start_workers()
@@ -0,0 +1,246 @@
+"""
+Durable background job queue stored in SQLite.
+
+Request handlers enqueue a job and return immediately. Every gunicorn worker runs a small pool of threads that claim jobs
+from the shared database file. A job claimed by a worker that died is claimed again once its lease expires, and failed
+jobs are retried with exponential backoff. Jobs of a kind registered with a batch size are claimed and handled together,
+and only removed once the handler returned.
+"""
+from __future__ import annotations
+
+import json
+import sqlite3
+from os import getenv, getpid
+from threading import Event, Lock, Thread, local
+from time import time
+from typing import Any, Callable, Optional
+
+import metrics
+from log_gen import create_logger
+
+JOB_QUEUE_PATH = getenv('JOB_QUEUE_PATH', "job_queue.db")
+JOB_WORKERS = int(getenv('JOB_WORKERS', 2))
+JOB_MAX_ATTEMPTS = int(getenv('JOB_MAX_ATTEMPTS', 5))
+JOB_RETRY_BACKOFF = float(getenv('JOB_RETRY_BACKOFF', 5))
+# A running job is handed to another worker if it isn't finished within this many seconds
+JOB_LEASE = float(getenv('JOB_LEASE', 5 * 60))
+JOB_POLL_INTERVAL = 1.0
+# Failed jobs are kept this many seconds for inspection, then deleted
+JOB_FAILED_RETENTION = float(getenv('JOB_FAILED_RETENTION', 7 * 24 * 60 * 60))
+JOB_PURGE_INTERVAL = 60 * 60
+
+logger = create_logger(__name__)
+_handlers: dict[str, Callable[[Any], None]] = {}
+_batch_sizes: dict[str, int] = {}
+_local = local()
+_wakeup = Event()
+_workers_pid: Optional[int] = None
+_workers_lock = Lock()
+_next_purge = 0.0
+
+
+def _connection() -> sqlite3.Connection:
+    # sqlite3 connections can't be shared between threads
+    if getattr(_local, "conn", None) is None:
+        conn = sqlite3.connect(JOB_QUEUE_PATH, timeout=10, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS jobs (id INTEGER PRIMARY KEY, kind TEXT NOT NULL, payload TEXT NOT NULL, "
+                     "dedup_key TEXT, status TEXT NOT NULL DEFAULT 'pending', attempts INTEGER NOT NULL DEFAULT 0, "
+                     "created_at REAL NOT NULL, run_at REAL NOT NULL, locked_until REAL, last_error TEXT)")
+        # Only one pending job per dedup key, enqueueing again replaces its payload
+        conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS jobs_dedup ON jobs (kind, dedup_key) WHERE status = 'pending'")
+        conn.execute("CREATE INDEX IF NOT EXISTS jobs_status_run_at ON jobs (status, run_at)")
+        _local.conn = conn
+    return _local.conn
+
+
+def handler(kind: str, *, batch_size: Optional[int] = None) -> Callable:
+    """
+    Registers the decorated function as the handler of a job kind. The handler gets the payload and raises to retry.
+
+    :param kind: Job kind
+    :param batch_size: If set, the handler gets a list of the payloads of up to this many jobs claimed together, and
+                       raising retries all of them
+    :return: Decorator
+    """
+
+    def register(func: Callable[[Any], None]) -> Callable[[Any], None]:
+        _handlers[kind] = func
+        if batch_size is not None:
+            _batch_sizes[kind] = batch_size
+        return func
+
+    return register
+
+
+def enqueue(kind: str, payload: Any, *, dedup_key: Optional[str] = None, delay: float = 0) -> None:
+    """
+    Adds a job to the queue.
+
+    :param kind: Job kind
+    :param payload: JSON serializable payload passed to the handler
+    :param dedup_key: If a job of the same kind with this key is still pending, its payload is replaced instead
+    :param delay: Seconds before the job is run. For a batched kind, jobs enqueued meanwhile are handled with it.
+    """
+    now = time()
+    if dedup_key is None:
+        _connection().execute("INSERT INTO jobs (kind, payload, created_at, run_at) VALUES (?, ?, ?, ?)",
+                              (kind, json.dumps(payload), now, now + delay))
+    else:
+        _connection().execute("INSERT INTO jobs (kind, payload, dedup_key, created_at, run_at) VALUES (?, ?, ?, ?, ?) "
+                              "ON CONFLICT (kind, dedup_key) WHERE status = 'pending' DO UPDATE SET payload = excluded.payload",
+                              (kind, json.dumps(payload), dedup_key, now, now + delay))
+    metrics.incr(f"jobs_enqueued_total{{kind=\"{kind}\"}}")
+    _wakeup.set()
+
+
+def _claim(*, include_delayed: bool = False) -> list[sqlite3.Row]:
+    conn = _connection()
+    now = time()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        if include_delayed:
+            kinds = list(_handlers)
+            jobs = conn.execute(f"SELECT * FROM jobs WHERE status = 'pending' AND (run_at <= ? OR attempts = 0) "
+                                f"AND kind IN ({', '.join('?' * len(kinds))}) ORDER BY run_at LIMIT 1", (now, *kinds)).fetchall()
+        else:
+            jobs = conn.execute("SELECT * FROM jobs WHERE (status = 'pending' AND run_at <= ?) OR (status = 'running' AND locked_until < ?) "
+                                "ORDER BY run_at LIMIT 1", (now, now)).fetchall()
+        if jobs and (batch_size := _batch_sizes.get(jobs[0]["kind"], 1)) > 1:
+            # Jobs still waiting out their delay join the batch, jobs waiting out a retry backoff don't
+            jobs += conn.execute("SELECT * FROM jobs WHERE kind = ? AND status = 'pending' AND id != ? AND (run_at <= ? OR attempts = 0) "
+                                 "ORDER BY run_at LIMIT ?", (jobs[0]["kind"], jobs[0]["id"], now, batch_size - 1)).fetchall()
+        conn.executemany("UPDATE jobs SET status = 'running', attempts = attempts + 1, locked_until = ? WHERE id = ?",
+                         [(now + JOB_LEASE, job["id"]) for job in jobs])
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    return jobs
+
+
+def _run(jobs: list[sqlite3.Row]) -> None:
+    conn = _connection()
+    kind = jobs[0]["kind"]
+    payloads = [json.loads(job["payload"]) for job in jobs]
+    try:
+        _handlers[kind](payloads if kind in _batch_sizes else payloads[0])
+    except Exception as e:
+        logger.exception(f"Job {', '.join(str(job['id']) for job in jobs)} {kind} failed: {e}", exc_info=True)
+        for job in jobs:
+            _retry_or_fail(conn, job, e)
+    else:
+        conn.executemany("DELETE FROM jobs WHERE id = ?", [(job["id"],) for job in jobs])
+        metrics.incr(f"jobs_completed_total{{kind=\"{kind}\"}}", len(jobs))
+        metrics.incr(f"jobs_latency_seconds_total{{kind=\"{kind}\"}}", sum(time() - job["created_at"] for job in jobs))
+
+
+def _retry_or_fail(conn: sqlite3.Connection, job: sqlite3.Row, e: Exception) -> None:
+    kind = job["kind"]
+    attempts = job["attempts"] + 1
+    if attempts >= JOB_MAX_ATTEMPTS:
+        # run_at of a failed job is the time it failed, purge_failed deletes it once that is older than JOB_FAILED_RETENTION
+        conn.execute("UPDATE jobs SET status = 'failed', run_at = ?, last_error = ? WHERE id = ?", (time(), str(e), job["id"]))
+        metrics.incr(f"jobs_failed_total{{kind=\"{kind}\"}}")
+    else:
+        try:
+            conn.execute("UPDATE jobs SET status = 'pending', run_at = ?, last_error = ? WHERE id = ?",
+                         (time() + JOB_RETRY_BACKOFF * 2 ** (attempts - 1), str(e), job["id"]))
+            metrics.incr(f"jobs_retried_total{{kind=\"{kind}\"}}")
+        except sqlite3.IntegrityError:
+            # A job with the same dedup key was enqueued while this one ran. It has the newer payload, so this one is
+            # merged into it by dropping it.
+            conn.execute("DELETE FROM jobs WHERE id = ?", (job["id"],))
+            metrics.incr(f"jobs_merged_total{{kind=\"{kind}\"}}")
+
+
+def purge_failed() -> int:
+    """
+    Deletes the jobs that failed more than JOB_FAILED_RETENTION seconds ago. Their payloads stay in the database file
+    until then.
+
+    :return: Number of jobs deleted
+    """
+    deleted = _connection().execute("DELETE FROM jobs WHERE status = 'failed' AND run_at < ?", (time() - JOB_FAILED_RETENTION,)).rowcount
+    metrics.incr("jobs_purged_total", deleted)
+    return deleted
+
+
+def _purge_if_due() -> None:
+    global _next_purge
+    with _workers_lock:
+        if time() < _next_purge:
+            return
+        _next_purge = time() + JOB_PURGE_INTERVAL
+    purge_failed()
+
+
+def _work_loop():
+    while True:
+        try:
+            _purge_if_due()
+            if (jobs := _claim()) and jobs[0]["kind"] in _handlers:
+                _run(jobs)
+                continue
+            if jobs:
+                logger.error(f"No handler for job {jobs[0]['id']} {jobs[0]['kind']}")
+        except Exception as e:
+            logger.exception(str(e), exc_info=True)
+        _wakeup.wait(JOB_POLL_INTERVAL)
+        _wakeup.clear()
+
+
+def drain() -> int:
+    """
+    Runs the pending jobs in the calling thread until none is left, including jobs still waiting out their delay, e.g.
+    before a script that enqueued jobs exits. Failed jobs are left for the workers of the app to retry.
+
+    :return: Number of jobs run
+    """
+    count = 0
+    while jobs := _claim(include_delayed=True):
+        _run(jobs)
+        count += len(jobs)
+    return count
+
+
+def start_workers() -> None:
+    """
+    Starts the worker threads of this process if they aren't running yet. Called once the handlers are registered,
+    when the app is loaded in a gunicorn worker.
+    """
+    global _workers_pid
+    if _workers_pid != getpid():
+        with _workers_lock:
+            if _workers_pid != getpid():
+                for i in range(JOB_WORKERS):
+                    Thread(target=_work_loop, name=f"job_queue_{i}", daemon=True).start()
+                _workers_pid = getpid()
+
+
+def stats() -> dict[str, float]:
+    """
+    Queue depth by status, the number of running jobs whose lease expired and the age of the oldest pending job.
+
+    :return: Dict of stats
+    """
+    conn = _connection()
+    now = time()
+    stats_ = {status: 0 for status in ("pending", "running", "failed")}
+    stats_.update({row["status"]: row["count"] for row in conn.execute("SELECT status, COUNT(*) AS count FROM jobs GROUP BY status")})
+    stats_["expired_leases"] = conn.execute("SELECT COUNT(*) FROM jobs WHERE status = 'running' AND locked_until < ?", (now,)).fetchone()[0]
+    oldest = conn.execute("SELECT MIN(created_at) FROM jobs WHERE status = 'pending'").fetchone()[0]
+    stats_["oldest_pending_seconds"] = now - oldest if oldest else 0
+    return stats_
+
+
+def gauges() -> dict[str, float]:
+    """
+    The stats as Prometheus gauges.
+
+    :return: Dict of gauge name to value
+    """
+    stats_ = stats()
+    gauges_ = {f"job_queue_jobs{{status=\"{status}\"}}": stats_.pop(status) for status in ("pending", "running", "failed")}
+    return gauges_ | {f"job_queue_{name}": value for name, value in stats_.items()}
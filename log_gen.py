@@ -1,18 +1,132 @@
+"""
+Logging setup shared by all modules.
+
+logging.conf is read once, the first time a logger is created. The loggers then only put their records on a queue, and
+a single listener thread formats them and writes them to the handlers of logging.conf, so file I/O never happens on the
+request threads.
+
+LOG_FORMAT selects json, one JSON object per line, or text, the format of logging.conf. LOG_SAMPLE_RATES keeps only a
+fraction of the INFO and DEBUG records of some loggers, e.g. "profile.visits=0.1". Warnings and errors are always kept.
+"""
 from __future__ import annotations
 
+import atexit
+import copy
+import json
 import logging
+import os
+import random
+from datetime import datetime, timezone
 from logging.config import fileConfig
+from logging.handlers import QueueHandler, QueueListener
+from queue import SimpleQueue
+from threading import Lock
+from typing import Optional
+
+LOG_CONFIG_PATH = os.getenv('LOG_CONFIG_PATH', "logging.conf")
+LOG_FORMAT = os.getenv('LOG_FORMAT', "json")
+LOG_SAMPLE_RATES = os.getenv('LOG_SAMPLE_RATES', "profile.visits=0.1")
+
+_setup_lock = Lock()
+_listener: Optional[QueueListener] = None
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats a record as one JSON object per line.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "location": f"{record.filename}.{record.funcName}:{record.lineno}",
+            "message": record.getMessage(),
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        if hasattr(record, "sample_rate"):
+            entry["sample_rate"] = record.sample_rate
+        return json.dumps(entry, default=str)
+
+
+class SampleFilter(logging.Filter):
+    """
+    Keeps a random fraction of the INFO and DEBUG records of a logger, and every record of a higher level.
+    """
+
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > logging.INFO:
+            return True
+        if random.random() < self.rate:
+            record.sample_rate = self.rate
+            return True
+        return False
+
+
+class _QueueHandler(QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Only the message is merged on the calling thread, the formatting is left to the handlers behind the queue
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def _parse_sample_rates(rates: str) -> dict[str, float]:
+    return {name.strip(): float(rate) for name, _, rate in (item.partition("=") for item in rates.split(",") if item.strip())}
+
+
+def _restart_listener() -> None:
+    # The listener thread doesn't survive a fork, e.g. when gunicorn preloads the app
+    global _listener
+    _listener = QueueListener(_listener.queue, *_listener.handlers, respect_handler_level=True)
+    _listener.start()
+
+
+def _setup() -> None:
+    global _listener
+    fileConfig(LOG_CONFIG_PATH, disable_existing_loggers=False)
+    root = logging.getLogger()
+    handlers = list(root.handlers)
+    # Only the loggers of logging.conf are moved to the queue, libraries keep their own handlers
+    loggers = [root] + [logger for logger in logging.Logger.manager.loggerDict.values()
+                        if isinstance(logger, logging.Logger) and logger.handlers and all(handler in handlers for handler in logger.handlers)]
+    if LOG_FORMAT == "json":
+        for handler in handlers:
+            handler.setFormatter(JsonFormatter())
+    queue_handler = _QueueHandler(SimpleQueue())
+    for logger in loggers:
+        logger.handlers = [queue_handler]
+    for name, rate in _parse_sample_rates(LOG_SAMPLE_RATES).items():
+        logging.getLogger(name).addFilter(SampleFilter(rate))
+    _listener = QueueListener(queue_handler.queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    os.register_at_fork(after_in_child=_restart_listener)
+    atexit.register(lambda: _listener.stop())
 
 
 def create_logger(logger_name: str) -> logging.Logger:
     """
-    Creates logger and returns an instance of logging object.
+    Creates logger and returns an instance of logging object. Logging is set up on the first call.
 
     :param logger_name: Gets the logger by that name
 
     :return: Logging Object.
     """
-    # Setting up the logger
-    fileConfig("logging.conf")
+    if _listener is None:
+        with _setup_lock:
+            if _listener is None:
+                _setup()
     logger = logging.getLogger(logger_name)
     return logger
@@ -4,22 +4,64 @@ from os import getenv
 from time import time
 
 from dotenv import load_dotenv
-from flask import Flask, render_template, redirect, request, session, url_for
+from flask import Flask, Response, abort, render_template, redirect, request, session, url_for
 from requests import HTTPError
 
+# Loaded before the local modules since they read their settings from the environment on import
+load_dotenv('config.env')
+
+import blacklist_index
 import deta_api
+import flair_index
+import job_queue
+import metrics
 import reddit_api
+import tracing
 from log_gen import create_logger
 from profile import profile
+from storage import ItemExistsError
 from user_verification import user_verification
 
 app = Flask(__name__)
 app.register_blueprint(user_verification, url_prefix="/user_verification")
 app.register_blueprint(profile, url_prefix="/user")
-load_dotenv('config.env')
 app.secret_key = getenv('FLASK_SECRET_KEY')
 app.permanent_session_lifetime = timedelta(days=7)
+# Teardowns run in reverse order, so the writes of the unit of work are part of the traced request
+app.teardown_request(tracing.end_request)
+app.teardown_request(deta_api.flush_unit_of_work)
+app.after_request(tracing.add_server_timing)
 logger = create_logger(__name__)
+flair_index.start_refresh_thread()
+blacklist_index.start_sync_thread()
+metrics.start_flush_thread()
+# The job handlers are registered by the blueprints imported above
+job_queue.start_workers()
+
+
+@app.before_request
+def start_trace():
+    tracing.start_request(request.endpoint)
+
+
+def is_local_request() -> bool:
+    """
+    Whether the request was made on this host, not forwarded by Cloudflare or a local reverse proxy.
+    """
+    forwarded = any(header in request.headers for header in ('Cf-Connecting-Ip', 'X-Forwarded-For', 'X-Real-Ip', 'Forwarded'))
+    return request.remote_addr in ('127.0.0.1', '::1') and not forwarded
+
+
+@app.route('/metrics')
+def prometheus_metrics():
+    # Counters of all the gunicorn workers and the depth of the shared job queue in the Prometheus text format
+    if token := getenv('METRICS_TOKEN'):
+        if request.headers.get('Authorization') != f"Bearer {token}":
+            abort(401)
+    elif not is_local_request():
+        # Without a token only a scraper on this host gets the metrics, the site is otherwise public through Cloudflare
+        abort(404)
+    return Response(metrics.render(metrics.aggregate(), job_queue.gauges()), mimetype="text/plain; version=0.0.4")
 
 
 @app.route('/login/callback')
@@ -36,15 +78,17 @@ def reddit_oauth_callback():
         session['code'] = request.args.get('code')
         username = reddit_api.get_username(code=session['code']).lower()
         fetch_res = deta_api.get_item(username)
-        logger.info(f"{username}, {session['code']} {fetch_res.items}")
+        logger.info("%s, %s %s", username, session['code'], fetch_res.items)
         # If user doesn't exist in db
         if fetch_res.count == 0:
-            deta_api.insert_item({"key": username,
-                                  "created_at": time(),
-                                  "code": session.get('code'),
-                                  "refresh_token": session.get('refresh_token'),
-                                  "is_blacklisted": False,
-                                  "verification_complete": False})
+            # A repeated callback for the same new user may have inserted it already
+            with suppress(ItemExistsError):
+                deta_api.insert_item({"key": username,
+                                      "created_at": time(),
+                                      "code": session.get('code'),
+                                      "refresh_token": session.get('refresh_token'),
+                                      "is_blacklisted": False,
+                                      "verification_complete": False})
             session['verification_started'] = True
             return render_template("platform.html", enable_warning=False)
         # If user exists but verification is not complete
@@ -58,8 +102,7 @@ def reddit_oauth_callback():
             return render_template("platform.html", enable_warning=False)
         # If user exists and verification is complete
         elif fetch_res.items[0].get("verification_complete"):
-            updated_data = fetch_res.items[0] | {"code": session.get('code'), "refresh_token": session.get('refresh_token')}
-            deta_api.update_item(updated_data, username)
+            deta_api.stage_update(username, {"code": session.get('code'), "refresh_token": session.get('refresh_token')})
             return redirect(url_for("profile.user_profile", user_name=username))
         else:
             return render_template("error.html", error_title="Internal Server Error", error_message="Internal Server Error."
@@ -84,7 +127,7 @@ def index():
     with suppress(HTTPError):
         username = reddit_api.get_username(refresh_token=session.get('refresh_token'))
         fetch_res = deta_api.get_item(username.lower())
-        logger.info(f"{username}, {fetch_res.items}")
+        logger.info("%s, %s", username, fetch_res.items)
         if fetch_res.count > 0 and fetch_res.items[0].get("verification_complete"):
             return redirect(url_for("profile.user_profile", user_name=username))
     return render_template('login.html')
@@ -0,0 +1,211 @@
+"""
+Process wide counters and histograms, exported in the Prometheus text format.
+
+Every gunicorn worker keeps its own counters. When METRICS_DIR is set each worker writes its counters to a file there
+every METRICS_FLUSH_INTERVAL seconds, and aggregate sums the files of all the workers. gunicorn.conf.py points
+METRICS_DIR to a new temporary directory for every run unless it is set.
+"""
+from __future__ import annotations
+
+import atexit
+import json
+from collections import defaultdict
+from contextlib import contextmanager
+from glob import glob
+from os import getenv, getpid, makedirs, path, remove, replace
+from threading import Event, Lock, Thread
+from time import perf_counter
+from typing import Iterator, Optional
+
+METRICS_DIR = getenv('METRICS_DIR')
+METRICS_FLUSH_INTERVAL = float(getenv('METRICS_FLUSH_INTERVAL', 10))
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+_lock = Lock()
+_counters: defaultdict[str, float] = defaultdict(float)
+_flush_pid: Optional[int] = None
+_flush_lock = Lock()
+
+
+def incr(name: str, value: float = 1) -> None:
+    """
+    Increments a process wide counter.
+
+    :param name: Name of the counter
+    :param value: Amount to add to the counter
+    """
+    with _lock:
+        _counters[name] += value
+
+
+def get(name: str) -> float:
+    """
+    Gets the current value of a counter.
+
+    :param name: Name of the counter
+    :return: Value of the counter, 0 if it was never incremented
+    """
+    with _lock:
+        return _counters.get(name, 0)
+
+
+def snapshot() -> dict[str, float]:
+    """
+    Takes a copy of all the counters of this process.
+
+    :return: Dict of counter name to value
+    """
+    with _lock:
+        return dict(_counters)
+
+
+@contextmanager
+def timer(name: str) -> Iterator[None]:
+    """
+    Counts the calls and the seconds spent in the with block as {name}_total and {name}_seconds_total.
+
+    :param name: Name prefix of the counters
+    """
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        incr(f"{name}_total")
+        incr(f"{name}_seconds_total", perf_counter() - start)
+
+
+def format_labels(labels: dict[str, str]) -> str:
+    """
+    Formats labels the way they are written after a metric name.
+
+    :param labels: Dict of label name to value
+    :return: e.g. {upstream="reddit",endpoint="profile.user_profile"}, or an empty string without labels
+    """
+    if not labels:
+        return ""
+    values = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for value in labels.values())
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(labels, values)) + "}"
+
+
+def observe(name: str, value: float, labels: Optional[dict[str, str]] = None, buckets: tuple[float, ...] = DEFAULT_BUCKETS) -> None:
+    """
+    Records a value in a histogram, kept as the {name}_bucket, {name}_sum and {name}_count counters of Prometheus.
+
+    :param name: Name of the histogram
+    :param value: Observed value, e.g. seconds
+    :param labels: Labels of the histogram
+    :param buckets: Upper bounds of the buckets
+    """
+    labels = labels or {}
+    with _lock:
+        for bound in buckets:
+            if value <= bound:
+                _counters[f"{name}_bucket{format_labels(labels | {'le': str(bound)})}"] += 1
+        _counters[f"{name}_bucket{format_labels(labels | {'le': '+Inf'})}"] += 1
+        _counters[f"{name}_sum{format_labels(labels)}"] += value
+        _counters[f"{name}_count{format_labels(labels)}"] += 1
+
+
+def _snapshot_path(pid: int) -> str:
+    return path.join(METRICS_DIR, f"{pid}.json")
+
+
+def write_snapshot() -> None:
+    """
+    Writes the counters of this process to METRICS_DIR, atomically so readers never see a half written file.
+    """
+    if not METRICS_DIR:
+        return
+    makedirs(METRICS_DIR, exist_ok=True)
+    file_path = _snapshot_path(getpid())
+    with open(f"{file_path}.tmp", "w") as fp:
+        json.dump(snapshot(), fp)
+    replace(f"{file_path}.tmp", file_path)
+
+
+def clear_snapshots() -> None:
+    """
+    Removes the files of previous runs, called by the gunicorn master before it starts the workers.
+    """
+    if METRICS_DIR:
+        for file_path in glob(path.join(METRICS_DIR, "*.json")):
+            remove(file_path)
+
+
+def aggregate() -> dict[str, float]:
+    """
+    Sums the counters of all the workers. The files of workers that have exited are kept so the counters never go down.
+
+    :return: Dict of counter name to value
+    """
+    if not METRICS_DIR:
+        return snapshot()
+    write_snapshot()
+    totals: defaultdict[str, float] = defaultdict(float)
+    for file_path in glob(path.join(METRICS_DIR, "*.json")):
+        try:
+            with open(file_path) as fp:
+                counters = json.load(fp)
+        except (OSError, ValueError):
+            continue
+        for name, value in counters.items():
+            totals[name] += value
+    return dict(totals)
+
+
+def _family(name: str, histograms: set[str]) -> str:
+    base = name.partition("{")[0]
+    for suffix in ("_bucket", "_sum", "_count"):
+        if base.endswith(suffix) and base[:-len(suffix)] in histograms:
+            return base[:-len(suffix)]
+    return base
+
+
+def _series_order(name: str) -> tuple:
+    # Buckets of a histogram are listed by their upper bound, +Inf last
+    base, _, labels = name.partition("{")
+    labels, _, le = labels.rpartition(',le="') if ',le="' in labels else (labels, "", "")
+    return base, labels, float(le.rstrip('"}')) if le else 0.0
+
+
+def render(counters: dict[str, float], gauges: Optional[dict[str, float]] = None) -> str:
+    """
+    Formats counters and gauges in the Prometheus text format, with a TYPE line before every metric.
+
+    :param counters: Dict of counter name to value, histograms included
+    :param gauges: Dict of gauge name to value, e.g. the depth of the job queue
+    :return: Text for a /metrics response
+    """
+    histograms = {name.partition("{")[0][:-len("_bucket")] for name in counters if name.partition("{")[0].endswith("_bucket")}
+    families: defaultdict[str, list[str]] = defaultdict(list)
+    types: dict[str, str] = {}
+    for series, kind in [(name, "counter") for name in counters] + [(name, "gauge") for name in gauges or {}]:
+        family = _family(series, histograms)
+        families[family].append(series)
+        types[family] = "histogram" if family in histograms else kind
+    values = counters | (gauges or {})
+    lines = []
+    for family in sorted(families):
+        lines.append(f"# TYPE {family} {types[family]}\n")
+        lines.extend(f"{series} {values[series]}\n" for series in sorted(families[family], key=_series_order))
+    return "".join(lines)
+
+
+def _flush_loop(stop: Event) -> None:
+    while not stop.wait(METRICS_FLUSH_INTERVAL):
+        write_snapshot()
+
+
+def start_flush_thread() -> None:
+    """
+    Starts writing the counters of this process to METRICS_DIR periodically, once per process.
+    """
+    global _flush_pid
+    if not METRICS_DIR:
+        return
+    with _flush_lock:
+        if _flush_pid == getpid():
+            return
+        _flush_pid = getpid()
+    Thread(target=_flush_loop, args=(Event(),), daemon=True, name="metrics_flush").start()
+    atexit.register(write_snapshot)
@@ -0,0 +1,62 @@
+"""
+Copies all records of a base from one storage backend to another.
+
+Usage: python migrate_storage.py --source deta --target sqlite [--base fallout_76_db]
+
+Records are streamed page by page and written in batches, so the whole base is never held in memory. Running it again
+overwrites the records already copied, so an interrupted migration can simply be restarted.
+"""
+from __future__ import annotations
+
+import argparse
+from time import perf_counter
+
+from dotenv import load_dotenv
+
+load_dotenv('config.env')
+
+import deta_api
+from log_gen import create_logger
+
+logger = create_logger(__name__)
+
+
+def migrate(source: str, target: str, base: str = "fallout_76_db", batch_size: int = 500) -> int:
+    """
+    Streams the records of a base from source to target.
+
+    :param source: Backend to read from, deta or sqlite
+    :param target: Backend to write to, deta or sqlite
+    :param base: Name of the base
+    :param batch_size: Number of records written at once
+    :return: Number of records copied
+    """
+    start = perf_counter()
+    source_base = deta_api.create_base(base, source)
+    target_base = deta_api.create_base(base, target)
+    copied = 0
+    batch = []
+    for item in source_base.iter_items():
+        batch.append(item)
+        if len(batch) >= batch_size:
+            target_base.put_many(batch)
+            copied += len(batch)
+            batch.clear()
+    if batch:
+        target_base.put_many(batch)
+        copied += len(batch)
+    logger.info(f"Copied {copied} records of {base} from {source} to {target} in {perf_counter() - start:.2f}s")
+    return copied
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Copy all records of a base between storage backends.")
+    parser.add_argument("--source", choices=["deta", "sqlite"], required=True)
+    parser.add_argument("--target", choices=["deta", "sqlite"], required=True)
+    parser.add_argument("--base", default="fallout_76_db")
+    args = parser.parse_args()
+    print(migrate(args.source, args.target, args.base))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,20 +1,34 @@
+import hashlib
+import json
 from os import getenv
+from time import time
 
 import requests
-from flask import Blueprint, render_template, redirect, session, url_for, request
-from psnawp_api import PSNAWP
+from flask import Blueprint, Response, make_response, render_template, redirect, session, url_for, request
 from psnawp_api.core.psnawp_exceptions import PSNAWPNotFound, PSNAWPAuthenticationError
 
+import cache
 import deta_api
+import psn_api
+import xbox_api
 from log_gen import create_logger
 from reddit_api import get_reddit_profile_info
 from user_verification import add_gamer_tag_to_db
 
 profile = Blueprint("profile", __name__)
 logger = create_logger(__name__)
+# Logged on every profile view, sampled with LOG_SAMPLE_RATES
+visit_logger = create_logger(f"{__name__}.visits")
 WINDOWS_LOGO_URI = "/static/images/windows.webp"
 XBOX_LOGO_URI = "/static/images/xbox_logo.webp"
 PLAYSTATION_LOGO_URI = "/static/images/playstation_logo.webp"
+# How long a profile rendered for visitors that aren't logged in is served from the cache
+PROFILE_PAGE_TTL = float(getenv('PROFILE_PAGE_TTL', 5 * 60))
+# How long Cloudflare may serve a cached profile. The Cloudflare cache rule has to bypass requests with a session cookie.
+PROFILE_PAGE_SHARED_MAX_AGE = int(getenv('PROFILE_PAGE_SHARED_MAX_AGE', 60))
+
+_page_cache = cache.create_cache("profile_pages", maxsize=int(getenv('PROFILE_PAGE_CACHE_MAXSIZE', 1024)), ttl=PROFILE_PAGE_TTL)
+deta_api.add_write_listener(_page_cache.delete)
 
 
 def user_not_found(username):
@@ -22,11 +36,44 @@ def user_not_found(username):
     return render_template("error.html", error_title=f"Could not find {username}", error_message=msg)
 
 
+def record_version(user_data: dict) -> str:
+    """
+    Hash of the user record, changes whenever the record is written with different data.
+
+    :param user_data: User record
+    :return: Version string
+    """
+    return hashlib.sha1(json.dumps(user_data, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+
+def cacheable_response(page: dict) -> Response:
+    """
+    Builds the response of a profile rendered for visitors that aren't logged in, answering 304 if the visitor has it.
+
+    :param page: Cached page with body, etag and rendered_at
+    :return: Response
+    """
+    response = make_response(page["body"])
+    response.set_etag(page["etag"])
+    response.last_modified = page["rendered_at"]
+    # Browsers revalidate every time, which is a cheap 304 while the page doesn't change
+    response.cache_control.public = True
+    response.cache_control.max_age = 0
+    response.cache_control.must_revalidate = True
+    response.cache_control.s_maxage = PROFILE_PAGE_SHARED_MAX_AGE
+    # Flask only adds this when the session isn't empty, without it a shared cache would serve this page to logged in users
+    response.vary.add("Cookie")
+    return response.make_conditional(request)
+
+
 @profile.route('/search_username', methods=['GET'])
 def search_user():
-    user_name = request.args.get('search_box')
+    user_name = request.args.get('search_box').strip()
     if user_name.startswith("u/"):
         user_name = user_name[2:]
+    # Anything that isn't a registered reddit username is tried as a GamerTag of any platform
+    elif deta_api.get_item(user_name).count == 0 and (owner := deta_api.find_user_by_gamer_tag(user_name)):
+        user_name = owner
     return redirect(url_for("profile.user_profile", user_name=user_name))
 
 
@@ -35,13 +82,20 @@ def user_profile(user_name: str):
     user_name = user_name.lower()
     fetch_res = deta_api.get_item(user_name)
 
-    logger.info(f"{user_name} profile visited by {session.get('username', '!NotLoggedIn')} "
-                f"{request.headers.get('Cf-Connecting-Ip', request.remote_addr)} {request.headers.get('User-Agent')}.")
+    visit_logger.info("%s profile visited by %s %s %s.", user_name, session.get('username', '!NotLoggedIn'),
+                      request.headers.get('Cf-Connecting-Ip', request.remote_addr), request.headers.get('User-Agent'))
     # If user doesn't exist in db
     if fetch_res.count == 0 or not fetch_res.items[0].get("verification_complete"):
         return render_template("error.html", error_title=f"Could not find {user_name}", error_message=f"The user does not exist or has not fully completed "
                                                                                                       f"verification process. If you are {user_name}, please "
                                                                                                       f"sign up again and finish the process.")
+    # Visitors that aren't logged in all get the same page, so it is rendered once per version of the record
+    is_anonymous = 'username' not in session
+    if is_anonymous:
+        version = record_version(fetch_res.items[0])
+        if (cached := _page_cache.get(user_name)) is not None and (page := json.loads(cached))["version"] == version:
+            return cacheable_response(page)
+
     # If reddit account is deleted later
     profile_info = get_reddit_profile_info(user_name)
     if profile_info.get("error"):
@@ -64,7 +118,16 @@ def user_profile(user_name: str):
         profile_info["my_profile_pic_uri"] = profile_info.get("profile_pic_uri")
 
     profile_info["is_blacklisted"] = fetch_res.items[0].get("is_blacklisted")
-    return render_template('profile.html', profile_info=profile_info)
+    body = render_template('profile.html', profile_info=profile_info)
+    # Pages with placeholders because reddit was unavailable aren't cached
+    if is_anonymous and not profile_info["is_degraded"]:
+        page = {"version": version, "etag": f"{version}-{hashlib.sha1(body.encode()).hexdigest()[:8]}", "rendered_at": int(time()), "body": body}
+        _page_cache.set(user_name, json.dumps(page))
+        return cacheable_response(page)
+    response = make_response(body)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
 
 
 @profile.route('/<user_name>/pc/update/', methods=["POST"])
@@ -86,36 +149,23 @@ def edit_pc_gamer_tag(user_name: str):
     return render_template("edit_pc_gamertag.html", user_name=user_name)
 
 
-def xuid_to_gamer_tag(xuid):
-    auth_headers = {"X-Authorization": getenv("XBOX_API")}
-    resp = requests.get(f'https://xbl.io/api/v2/account/{xuid}', headers=auth_headers)
-    resp.raise_for_status()
-    json_data = resp.json()
-    xbox_profile = json_data.get('profileUsers')[0]
-    gamer_tag = xbox_profile['settings'][2]['value']
-    return gamer_tag
-
-
 @profile.route('/update_info')
 def update_user_info():
     if session.get('username'):
         fetch_res = deta_api.get_item(session.get('username')).items[0]
         if xuid := fetch_res.get('XBOX_ID'):
             try:
-                fetch_res["XBOX"] = xuid_to_gamer_tag(xuid)
-                deta_api.update_item(fetch_res, session.get('username'))
+                fetch_res["XBOX"] = xbox_api.xuid_to_gamer_tag(xuid)
             except requests.HTTPError:
-                fetch_res["XBOX"] = "Failed to fetch the XBOX GamerTag."
-            deta_api.update_item(fetch_res, session.get('username'))
+                fetch_res["XBOX"] = deta_api.XBOX_GAMERTAG_PLACEHOLDER
+            deta_api.stage_update(session.get('username'), {"XBOX": fetch_res["XBOX"]})
             logger.info(f"XBOX GT updated to {fetch_res['XBOX']}")
         if psnid := fetch_res.get("PlayStation_ID"):
             try:
-                psnawp = PSNAWP(getenv('NPSSO'))
-                user = psnawp.user(account_id=f"{psnid}")
-                fetch_res["PlayStation"] = user.online_id
+                fetch_res["PlayStation"] = psn_api.account_id_to_online_id(f"{psnid}")
             except (PSNAWPNotFound, PSNAWPAuthenticationError):
-                fetch_res["PlayStation"] = "Failed to fetch the PSN GamerTag."
-            deta_api.update_item(fetch_res, session.get('username'))
+                fetch_res["PlayStation"] = deta_api.PSN_GAMERTAG_PLACEHOLDER
+            deta_api.stage_update(session.get('username'), {"PlayStation": fetch_res["PlayStation"]})
             logger.info(f"PlayStation GT updated to {fetch_res['PlayStation']}")
 
         return redirect(url_for("profile.user_profile", user_name=session['username']))
@@ -0,0 +1,91 @@
+from __future__ import annotations
+
+from os import getenv
+from threading import Lock
+from typing import Optional
+
+from psnawp_api import PSNAWP
+from psnawp_api.core.psnawp_exceptions import PSNAWPAuthenticationError
+from psnawp_api.models.user import User
+
+import metrics
+import tracing
+
+_psnawp: Optional[PSNAWP] = None
+_psnawp_lock = Lock()
+# PSNAWP refreshes its access token without any locking, so the threads of a worker take turns using the client
+_psnawp_call_lock = Lock()
+
+
+def get_psnawp() -> PSNAWP:
+    """
+    Gets the PSN client shared by the whole process. The NPSSO is only exchanged for tokens when the client is created,
+    after that PSNAWP refreshes the access token itself when it expires.
+
+    :return: Authenticated PSNAWP client
+    :raises PSNAWPAuthenticationError: If the NPSSO code has expired
+    """
+    global _psnawp
+    if _psnawp is None:
+        with _psnawp_lock:
+            if _psnawp is None:
+                with metrics.timer("psn_auth"):
+                    _psnawp = PSNAWP(getenv('NPSSO'))
+    return _psnawp
+
+
+def reset_psnawp() -> None:
+    """
+    Drops the shared client so the next call authenticates again, e.g. after the NPSSO code was replaced.
+    """
+    global _psnawp
+    with _psnawp_lock:
+        _psnawp = None
+
+
+def get_user(*, online_id: Optional[str] = None, account_id: Optional[str] = None) -> User:
+    """
+    Looks up a PSN user by online id or account id
+
+    :param online_id: PSN online id
+    :param account_id: PSN account id
+    :return: PSNAWP User
+    :raises PSNAWPNotFound: If the user doesn't exist
+    """
+    try:
+        with _psnawp_call_lock, metrics.timer("psn_lookup"), tracing.span("psn"):
+            if online_id is not None:
+                user = get_psnawp().user(online_id=online_id)
+            else:
+                user = get_psnawp().user(account_id=account_id)
+    except PSNAWPAuthenticationError:
+        reset_psnawp()
+        raise
+    return user
+
+
+def account_id_to_online_id(account_id: str) -> str:
+    """
+    Gets the current online id of an account
+
+    :param account_id: PSN account id
+    :return: online id
+    :raises PSNAWPNotFound: If the user doesn't exist
+    """
+    return get_user(account_id=str(account_id)).online_id
+
+
+def send_message(user: User, message: str) -> None:
+    """
+    Sends a message to the user in a group with the bot account
+
+    :param user: PSNAWP User
+    :param message: message content
+    """
+    try:
+        with _psnawp_call_lock, metrics.timer("psn_send"), tracing.span("psn"):
+            group = get_psnawp().group(users_list=[user])
+            group.send_message(message)
+    except PSNAWPAuthenticationError:
+        reset_psnawp()
+        raise
@@ -0,0 +1,16 @@
+"""
+Indexes the GamerTags of all users for the reverse lookup in profile.search_user.
+
+Usage: python rebuild_gamertag_index.py
+
+Every write keeps the index up to date, so this only has to run once for the records written before the index existed,
+or before its entries were split per platform.
+"""
+from dotenv import load_dotenv
+
+load_dotenv('config.env')
+
+import deta_api
+
+if __name__ == '__main__':
+    print(deta_api.rebuild_gamer_tag_index())
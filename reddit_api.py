@@ -1,37 +1,115 @@
 from __future__ import annotations
 
-import re
+import hashlib
+import json
+from concurrent.futures import ThreadPoolExecutor
+from http.cookiejar import DefaultCookiePolicy
 from os import getenv
-from typing import Optional
+from threading import Lock
+from time import time
+from typing import Any, Callable, Optional
 from urllib.parse import urlsplit, urljoin
 
 import praw
+import prawcore
 import requests
-import yaml
 from flask import session
 from requests import HTTPError
 from requests.auth import HTTPBasicAuth
 
+import cache
+import flair_index
+from circuit_breaker import CircuitBreaker, CircuitOpenError
+import metrics
+import roles
+import tracing
+from log_gen import create_logger
+from singleflight import SingleFlight
+
+REDDIT_URL = getenv('REDDIT_URL', "https://www.reddit.com")
+REDDIT_OAUTH_URL = getenv('REDDIT_OAUTH_URL', "https://oauth.reddit.com")
+USER_AGENT = "Fallout76MarketplaceUserVerification v0.0.1"
+REDDIT_TIMEOUT = float(getenv('REDDIT_TIMEOUT', 5))
+# After this many timeouts or errors in a row an upstream is not called for REDDIT_BREAKER_RESET seconds
+REDDIT_BREAKER_THRESHOLD = int(getenv('REDDIT_BREAKER_THRESHOLD', 5))
+REDDIT_BREAKER_RESET = float(getenv('REDDIT_BREAKER_RESET', 30))
+REDDIT_FAILURES = (requests.RequestException,)
+# Only these open the breaker, any PRAW error, e.g. bad or missing credentials, shows a placeholder
+PRAW_FAILURES = (prawcore.exceptions.RequestException, prawcore.exceptions.ServerError, prawcore.exceptions.TooManyRequests)
+PRAW_ERRORS = (prawcore.exceptions.PrawcoreException, praw.exceptions.PRAWException)
+DEFAULT_PROFILE_PIC_URI = "https://avatarfiles.alphacoders.com/917/91786.jpg"
+# Requests of all the threads of a gunicorn worker, and the fetches they start, share one pool of connections
+GUNICORN_THREADS = int(getenv('GUNICORN_THREADS', 1))
+REDDIT_FETCH_WORKERS = int(getenv('REDDIT_FETCH_WORKERS', max(8, 2 * GUNICORN_THREADS)))
+# How long each field of a profile is cached in seconds. Avatars rarely change, trading karma changes with every trade.
+PROFILE_FIELD_TTLS = {
+    "display_name": float(getenv('PROFILE_DISPLAY_NAME_TTL', 6 * 60 * 60)),
+    "profile_pic_uri": float(getenv('PROFILE_PIC_TTL', 6 * 60 * 60)),
+    "reddit_karma": float(getenv('PROFILE_REDDIT_KARMA_TTL', 30 * 60)),
+    "trading_karma": float(getenv('PROFILE_TRADING_KARMA_TTL', 10 * 60)),
+}
+ABOUT_FIELDS = ("display_name", "profile_pic_uri", "reddit_karma")
+# How long the last known value of a field is served while it is refreshed in the background
+PROFILE_MAX_STALENESS = float(getenv('PROFILE_MAX_STALENESS', 7 * 24 * 60 * 60))
+logger = create_logger(__name__)
+# Values are stored with the time they were fetched, under a new name so entries of the old format aren't read
+_profile_cache = cache.create_cache("reddit_profile_fields", maxsize=int(getenv('PROFILE_CACHE_MAXSIZE', 4096)),
+                                    ttl=max(PROFILE_MAX_STALENESS, *PROFILE_FIELD_TTLS.values()))
+# Access tokens stay in process memory only, they are never written to the shared cache file
+_token_cache = cache.create_cache("reddit_tokens", maxsize=int(getenv('TOKEN_CACHE_MAXSIZE', 4096)), ttl=60 * 60, shared=False)
+TOKEN_EXPIRY_MARGIN = 60
+_executor = ThreadPoolExecutor(max_workers=REDDIT_FETCH_WORKERS, thread_name_prefix="reddit_api")
+_session = requests.Session()
+# The session is shared by all users, so cookies reddit sets for one request must not be sent with the next one
+_session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+_session.mount("https://", tracing.TracedHTTPAdapter("reddit", pool_maxsize=REDDIT_FETCH_WORKERS + GUNICORN_THREADS))
+_session.mount("http://", tracing.TracedHTTPAdapter("reddit", pool_maxsize=REDDIT_FETCH_WORKERS + GUNICORN_THREADS))
+# Visitors opening the same profile at the same time share one about.json and flair request
+_about_flight = SingleFlight("reddit_about")
+_flair_flight = SingleFlight("reddit_flair")
+_reddit_breaker = CircuitBreaker("reddit", failure_threshold=REDDIT_BREAKER_THRESHOLD, reset_timeout=REDDIT_BREAKER_RESET, failures=REDDIT_FAILURES)
+_praw_breaker = CircuitBreaker("praw", failure_threshold=REDDIT_BREAKER_THRESHOLD, reset_timeout=REDDIT_BREAKER_RESET, failures=PRAW_FAILURES)
+_refreshing: set[tuple[Callable, str]] = set()
+_refreshing_lock = Lock()
+_praw_reddit: Optional[praw.Reddit] = None
+_praw_lock = Lock()
+# praw.Reddit isn't thread safe, so the threads of a worker take turns using the shared instance
+_praw_call_lock = Lock()
+
 
 def save_data_to_session(username: str, refresh_token: str) -> None:
     session['username'] = username.lower()
     session['refresh_token'] = refresh_token
 
 
+def cache_tokens(tokens: dict) -> None:
+    """
+    Caches the tokens, and the username if it is known, under a hash of the refresh token until the access token expires.
+
+    :param tokens: Tokens returned by reddit, optionally with the username under name
+    """
+    if tokens.get('refresh_token'):
+        key = hashlib.sha256(tokens['refresh_token'].encode()).hexdigest()
+        _token_cache.set(key, json.dumps(tokens), tokens.get('expires_in', 60 * 60) - TOKEN_EXPIRY_MARGIN)
+
+
 def access_token_from_refresh_token(refresh_token: str) -> (int, dict):
     """
-    Gets access token from refresh token
+    Gets access token from refresh token. The access token is reused from the cache until it expires.
 
     :param refresh_token: Reddit Refresh Token
     :return: Dict with access_token and status code
     :raises HTTPError: If an HTTP Error occurs
     """
+    if (cached := _token_cache.get(hashlib.sha256(refresh_token.encode()).hexdigest())) is not None:
+        return 200, json.loads(cached)
     auth = HTTPBasicAuth(getenv('CLIENT_ID'), getenv('CLIENT_SECRET'))
-    header = {'User-agent': 'Fallout76MarketplaceUserVerification v0.0.1'}
+    header = {'User-agent': USER_AGENT}
     data = {'grant_type': 'refresh_token', 'refresh_token': refresh_token}
-    res = requests.post('https://www.reddit.com/api/v1/access_token', auth=auth, headers=header, data=data)
+    res = _session.post(f'{REDDIT_URL}/api/v1/access_token', auth=auth, headers=header, data=data)
     res.raise_for_status()
     json_data = res.json() | {"refresh_token": refresh_token}  # Adding refresh token back for consistency
+    cache_tokens(json_data)
     return res.status_code, json_data
 
 
@@ -44,9 +122,9 @@ def access_token_from_code(code: str) -> (int, dict):
     :raises HTTPError: If an HTTP Error occurs
     """
     auth = HTTPBasicAuth(getenv('CLIENT_ID'), getenv('CLIENT_SECRET'))
-    header = {'User-agent': 'Fallout76MarketplaceUserVerification v0.0.1'}
+    header = {'User-agent': USER_AGENT}
     data = {'grant_type': 'authorization_code', 'code': code, 'redirect_uri': getenv('redirect_uri')}
-    res = requests.post('https://www.reddit.com/api/v1/access_token', auth=auth, headers=header, data=data)
+    res = _session.post(f'{REDDIT_URL}/api/v1/access_token', auth=auth, headers=header, data=data)
     res.raise_for_status()
     json_data = res.json()
     return res.status_code, json_data
@@ -70,7 +148,8 @@ def get_access_token(tokens: dict) -> (int, dict):
 
 def get_username(*, code: Optional[str] = None, refresh_token: Optional[str] = None) -> str:
     """
-    Gets username from code or refresh token passed as an argument
+    Gets username from code or refresh token passed as an argument. The username is cached along with the access token
+    so a returning user doesn't need any request to reddit until the access token expires.
 
     :param refresh_token: Refresh Token from oauth
     :param code: oauth code
@@ -78,10 +157,16 @@ def get_username(*, code: Optional[str] = None, refresh_token: Optional[str] = N
     """
     status_code, tokens = get_access_token({'code': code, 'refresh_token': refresh_token})
     if status_code == 200:
-        header = {'Authorization': f"bearer {tokens['access_token']}", 'User-agent': 'Fallout76MarketplaceUserVerification v0.0.1'}
-        res = requests.get('https://oauth.reddit.com/api/v1/me', headers=header)
-        save_data_to_session(res.json()['name'], tokens['refresh_token'])
-        return res.json()['name']
+        if tokens.get('name'):
+            metrics.incr("reddit_username_cache_hits_total")
+        else:
+            metrics.incr("reddit_username_cache_misses_total")
+            header = {'Authorization': f"bearer {tokens['access_token']}", 'User-agent': USER_AGENT}
+            res = _session.get(f'{REDDIT_OAUTH_URL}/api/v1/me', headers=header)
+            tokens['name'] = res.json()['name']
+            cache_tokens(tokens)
+        save_data_to_session(tokens['name'], tokens['refresh_token'])
+        return tokens['name']
     else:
         raise HTTPError(f"{status_code}")
 
@@ -111,51 +196,95 @@ def check_if_courier(username):
     :param username: Reddit username
     :return: True if user is courier else False
     """
-    with open("couriers.yaml", 'r') as fp:
-        courier_list = yaml.safe_load(fp)
-        courier_list = courier_list.get('couriers', [])
-    if username.lower() in courier_list:
-        return True
-    else:
-        return False
+    return roles.registry.has_role("couriers", username)
 
 
-def get_trading_karma(username: str) -> str:
+class _PrawHTTPAdapter(tracing.TracedHTTPAdapter):
+    """
+    Counts the token requests of prawcore against the API requests made with a token it already had.
     """
-    Gets the trading karma of a user by grabbing their flair info in r/Fallout76Marketplace
 
-    :param username: Reddit username
-    :return: Trading Karma of the user
+    def send(self, request, *args, **kwargs):
+        if urlsplit(request.url).path.endswith("/api/v1/access_token"):
+            metrics.incr("praw_token_refreshes_total")
+        else:
+            metrics.incr("praw_token_reuses_total")
+        return super().send(request, *args, **kwargs)
+
+
+def create_praw_reddit() -> praw.Reddit:
+    """
+    Creates a Reddit instance with its own session and OAuth token.
+
+    :return: praw Reddit instance
     """
-    reddit = praw.Reddit(
+    # prawcore sets its headers on the session it is given, so it gets its own session
+    praw_session = requests.Session()
+    praw_session.mount("https://", _PrawHTTPAdapter("praw", pool_maxsize=REDDIT_FETCH_WORKERS))
+    praw_session.mount("http://", _PrawHTTPAdapter("praw", pool_maxsize=REDDIT_FETCH_WORKERS))
+    return praw.Reddit(
         client_id=getenv('PRAW_CLIENT_ID'),
         client_secret=getenv('PRAW_CLIENT_SECRET'),
         password=getenv('PRAW_PASSWORD'),
-        user_agent="Fallout76MarketplaceUserVerification v0.0.1",
+        user_agent=USER_AGENT,
         username=getenv('PRAW_USERNAME'),
+        reddit_url=REDDIT_URL,
+        oauth_url=REDDIT_OAUTH_URL,
+        requestor_kwargs={"session": praw_session},
+        timeout=REDDIT_TIMEOUT,
     )
 
-    subreddit = reddit.subreddit("Fallout76Marketplace")
-    flair = next(subreddit.flair(username))
-    flair_text = flair.get('flair_text')
-    if not flair_text:
-        return "0"
-    else:
-        if res := re.search(r"(?<=: )\d+\b", flair_text):
-            return res.group()
-        else:
-            return flair_text.split(' ')[-1]
 
+def get_praw_reddit() -> praw.Reddit:
+    """
+    Gets the Reddit instance shared by the whole process, creating it on first use. prawcore reuses its OAuth token
+    until it expires instead of requesting a new token on every profile view. Calls on it have to hold _praw_call_lock.
 
-def get_reddit_profile_info(user_name: str) -> dict:
+    :return: praw Reddit instance
     """
-    Gathers all the information on a reddit user such as profile pic, reddit karma, trading karma, courier status, etc.
+    global _praw_reddit
+    if _praw_reddit is None:
+        with _praw_lock:
+            if _praw_reddit is None:
+                _praw_reddit = create_praw_reddit()
+    return _praw_reddit
+
+
+def get_trading_karma(username: str) -> str:
+    """
+    Gets the trading karma of a user by grabbing their flair info in r/Fallout76Marketplace
+
+    :param username: Reddit username
+    :return: Trading Karma of the user
+    """
+    if (trading_karma := flair_index.lookup_trading_karma(username)) is not None:
+        return trading_karma
+    return _flair_flight.do(username.lower(), _praw_breaker.call, _get_flair_trading_karma, username)
+
+
+def _get_flair_trading_karma(username: str) -> str:
+    reddit = get_praw_reddit()
+    # The token is refreshed by prawcore within the call when it has expired, so the lock covers that too. The lock is
+    # held for the whole request, up to REDDIT_TIMEOUT, so live flair lookups of a worker run one at a time. Most
+    # lookups are answered by the flair index and concurrent lookups of one user share a call, so few get here.
+    with _praw_call_lock:
+        flair = next(reddit.subreddit("Fallout76Marketplace").flair(username), {})
+    return flair_index.parse_trading_karma(flair.get('flair_text'))
+
+
+def get_about_info(user_name: str) -> dict:
+    """
+    Gets the profile pic, display name and reddit karma of a user from their about.json
 
     :param user_name: Reddit username
-    :return: dict object containing all information
+    :return: dict with the fields in ABOUT_FIELDS or the error returned by reddit
+    :raises HTTPError: If reddit is rate limiting or unavailable
     """
-    reddit_profile_info = requests.get(f"https://www.reddit.com/user/{user_name}/about.json",
-                                       headers={'User-agent': 'Fallout76MarketplaceUserVerification v0.0.1'}).json()
+    res = _session.get(f"{REDDIT_URL}/user/{user_name}/about.json", headers={'User-agent': USER_AGENT}, timeout=REDDIT_TIMEOUT)
+    # Unlike a 404 these don't mean the user doesn't exist
+    if res.status_code == 429 or res.status_code >= 500:
+        res.raise_for_status()
+    reddit_profile_info = res.json()
 
     if reddit_profile_info.get("error"):
         return reddit_profile_info
@@ -166,15 +295,108 @@ def get_reddit_profile_info(user_name: str) -> dict:
         profile_pic_uri = reddit_profile_info['data'].get('icon_img', "https://avatarfiles.alphacoders.com/917/91786.jpg")
     reddit_karma = display_stats(reddit_profile_info['data'].get('total_karma'))
     profile_pic_uri = urljoin(profile_pic_uri, urlsplit(profile_pic_uri).path)
-
-    trading_karma = get_trading_karma(user_name)
-    is_courier = check_if_courier(user_name)
-
-    profile_info = {
+    return {
         "display_name": reddit_profile_info['data'].get('name', user_name),
         "profile_pic_uri": profile_pic_uri,
         "reddit_karma": reddit_karma,
-        "trading_karma": trading_karma,
-        "is_courier": is_courier
     }
+
+
+def _store_field(key: str, field: str, value: str) -> None:
+    _profile_cache.set(f"{key}:{field}", json.dumps([value, time()]))
+
+
+def _fetch_about(user_name: str) -> dict:
+    """
+    Fetches about.json and caches its fields. The fields of a user reddit doesn't know anymore are dropped.
+    """
+    key = user_name.lower()
+    about_info = _about_flight.do(key, _reddit_breaker.call, get_about_info, user_name)
+    for field in ABOUT_FIELDS:
+        if about_info.get("error"):
+            _profile_cache.delete(f"{key}:{field}")
+        else:
+            _store_field(key, field, about_info[field])
+    return about_info
+
+
+def _fetch_trading_karma(user_name: str) -> str:
+    trading_karma = get_trading_karma(user_name)
+    _store_field(user_name.lower(), "trading_karma", trading_karma)
+    return trading_karma
+
+
+def _refresh_in_background(fetch: Callable[[str], Any], user_name: str) -> None:
+    refresh_key = (fetch, user_name.lower())
+    with _refreshing_lock:
+        if refresh_key in _refreshing:
+            return
+        _refreshing.add(refresh_key)
+
+    def refresh():
+        try:
+            fetch(user_name)
+            metrics.incr("reddit_profile_refreshes_total")
+        except Exception:
+            metrics.incr("reddit_profile_refresh_failures_total")
+        finally:
+            with _refreshing_lock:
+                _refreshing.discard(refresh_key)
+
+    _executor.submit(refresh)
+
+
+def get_reddit_profile_info(user_name: str) -> dict:
+    """
+    Gathers all the information on a reddit user such as profile pic, reddit karma, trading karma, courier status, etc.
+    Each field is fresh for its own ttl. After that the last known value is still served, for up to
+    PROFILE_MAX_STALENESS, while it is refreshed in the background. Only fields that aren't known at all are fetched
+    before returning, and if reddit is unavailable placeholders are shown for them.
+
+    :param user_name: Reddit username
+    :return: dict object containing all information, is_degraded is set if some fields are placeholders
+    """
+    key = user_name.lower()
+    now = time()
+    profile_info = {}
+    stale_fields = set()
+    for field, ttl in PROFILE_FIELD_TTLS.items():
+        if (cached := _profile_cache.get(f"{key}:{field}")) is not None:
+            profile_info[field], fetched_at = json.loads(cached)
+            if now - fetched_at >= ttl:
+                stale_fields.add(field)
+
+    about_future = None
+    trading_karma_future = None
+    if any(field not in profile_info for field in ABOUT_FIELDS):
+        about_future = tracing.submit(_executor, _fetch_about, user_name)
+    elif stale_fields.intersection(ABOUT_FIELDS):
+        _refresh_in_background(_fetch_about, user_name)
+    if "trading_karma" not in profile_info:
+        trading_karma_future = tracing.submit(_executor, _fetch_trading_karma, user_name)
+    elif "trading_karma" in stale_fields:
+        _refresh_in_background(_fetch_trading_karma, user_name)
+
+    profile_info["is_degraded"] = False
+    if about_future is not None:
+        try:
+            about_info = about_future.result()
+        except (CircuitOpenError, *REDDIT_FAILURES):
+            about_info = {"display_name": user_name, "profile_pic_uri": DEFAULT_PROFILE_PIC_URI, "reddit_karma": "?"}
+            profile_info["is_degraded"] = True
+        if about_info.get("error"):
+            # The result is shared with the other requests that waited for it
+            return dict(about_info)
+        for field in ABOUT_FIELDS:
+            profile_info[field] = about_info[field]
+    if trading_karma_future is not None:
+        try:
+            profile_info["trading_karma"] = trading_karma_future.result()
+        except (CircuitOpenError, *PRAW_ERRORS) as e:
+            if not isinstance(e, (CircuitOpenError, *PRAW_FAILURES)):
+                logger.warning(f"Could not get the trading karma of {user_name}: {e!r}")
+            profile_info["trading_karma"] = "?"
+            profile_info["is_degraded"] = True
+
+    profile_info["is_courier"] = check_if_courier(user_name)
     return profile_info
@@ -0,0 +1,132 @@
+"""
+Refreshes the XBOX and PlayStation GamerTags of all users so profiles show current names without users clicking update.
+
+Usage: python refresh_gamertags.py [--dry-run] [--interval SECONDS]
+
+The records are streamed from the database, names are resolved concurrently against xbl.io and PSN within a rate budget
+per api, and only the names that changed are written back. They are set field by field, so the rest of a record, which
+may have been changed since it was streamed, is never overwritten.
+"""
+from __future__ import annotations
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from os import getenv
+from threading import Lock
+from time import monotonic, sleep
+
+from dotenv import load_dotenv
+
+load_dotenv('config.env')
+
+import deta_api
+import psn_api
+import xbox_api
+from log_gen import create_logger
+
+# Requests per second allowed against each api
+XBOX_RATE_BUDGET = float(getenv('XBOX_RATE_BUDGET', 2))
+PSN_RATE_BUDGET = float(getenv('PSN_RATE_BUDGET', 2))
+REFRESH_WORKERS = int(getenv('REFRESH_WORKERS', 8))
+REFRESH_BATCH_SIZE = 100
+
+logger = create_logger(__name__)
+
+
+class RateLimiter:
+    """
+    Spaces calls out evenly so that no more than rate calls per second are made, across all threads.
+    """
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate
+        self._next = monotonic()
+        self._lock = Lock()
+
+    def wait(self) -> None:
+        with self._lock:
+            now = monotonic()
+            delay = self._next - now
+            self._next = max(self._next, now) + self.interval
+        if delay > 0:
+            sleep(delay)
+
+
+def _resolve(record: dict, xbox_limiter: RateLimiter, psn_limiter: RateLimiter) -> tuple[str, dict] | None:
+    """
+    Resolves the current names of a user
+
+    :return: The key and the changed fields of the record or None if nothing changed
+    """
+    changes = {}
+    if xuid := record.get('XBOX_ID'):
+        xbox_limiter.wait()
+        try:
+            changes["XBOX"] = xbox_api.xuid_to_gamer_tag(xuid)
+        except Exception as e:
+            logger.warning(f"Could not refresh XBOX GT of {record['key']}: {e}")
+    if psnid := record.get('PlayStation_ID'):
+        psn_limiter.wait()
+        try:
+            changes["PlayStation"] = psn_api.get_user(account_id=f"{psnid}").online_id
+        except Exception as e:
+            logger.warning(f"Could not refresh PlayStation GT of {record['key']}: {e}")
+    changes = {field: value for field, value in changes.items() if record.get(field) != value}
+    return (record["key"], changes) if changes else None
+
+
+def _write(key: str, changes: dict) -> None:
+    try:
+        deta_api.update_fields(key, changes)
+    except Exception as e:
+        # e.g. the user was deleted since the record was streamed
+        logger.warning(f"Could not write the GTs of {key}: {e}")
+
+
+def refresh(*, dry_run: bool = False) -> int:
+    """
+    Refreshes the names of all users with an XBOX or PlayStation account.
+
+    :param dry_run: Only log the changes without writing them
+    :return: Number of records that changed
+    """
+    xbox_limiter = RateLimiter(XBOX_RATE_BUDGET)
+    psn_limiter = RateLimiter(PSN_RATE_BUDGET)
+    changed = 0
+    batch = []
+
+    def flush():
+        nonlocal changed
+        updated = [result for result in executor.map(lambda rec: _resolve(rec, xbox_limiter, psn_limiter), batch) if result]
+        for key, changes in updated:
+            logger.info(f"{key} GTs updated to {changes}")
+        if updated and not dry_run:
+            list(executor.map(lambda result: _write(*result), updated))
+        changed += len(updated)
+        batch.clear()
+
+    with ThreadPoolExecutor(max_workers=REFRESH_WORKERS) as executor:
+        for record in deta_api.iter_items():
+            if record.get('XBOX_ID') or record.get('PlayStation_ID'):
+                batch.append(record)
+            if len(batch) >= REFRESH_BATCH_SIZE:
+                flush()
+        flush()
+    logger.info(f"GamerTag refresh done, {changed} records changed")
+    return changed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Refresh the XBOX and PlayStation GamerTags of all users.")
+    parser.add_argument("--dry-run", action="store_true", help="only log the changes")
+    parser.add_argument("--interval", type=float, default=0, help="keep running, refreshing every INTERVAL seconds")
+    args = parser.parse_args()
+    while True:
+        refresh(dry_run=args.dry_run)
+        if args.interval <= 0:
+            break
+        sleep(args.interval)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+"""
+Re-screens every verified user against the blacklist so scammers added to the boards after a user verified get flagged.
+
+Usage: python rescreen_blacklist.py [--dry-run] [--no-sync]
+
+The records are streamed from the database page by page, the identifiers of all users are deduplicated and each unique
+identifier is looked up once in the local blacklist mirror. Newly blacklisted users are flagged by setting only their
+is_blacklisted field, and the discord messages about them are sent before the script exits.
+With DETA_BASE_URL pointing at stubs/deta_base.py and TRELLO_API_URL at stubs/trello.py, it runs without Deta or
+Trello, the incremental sync of the mirror included.
+"""
+from __future__ import annotations
+
+import argparse
+from time import perf_counter
+
+from dotenv import load_dotenv
+
+load_dotenv('config.env')
+
+import blacklist_index
+import deta_api
+import job_queue
+from log_gen import create_logger
+from user_verification import Platform, blacklist_queries, send_message_to_discord
+
+logger = create_logger(__name__)
+
+
+def rescreen(*, dry_run: bool = False, sync: bool = True, page_size: int = 1000) -> list[str]:
+    """
+    Checks all verified users against the blacklist and flags the ones that are blacklisted.
+
+    :param dry_run: Only report the users without writing to the database or messaging discord
+    :param sync: Sync the blacklist mirror before screening
+    :param page_size: Number of records fetched per request
+    :return: Usernames that were newly flagged
+    """
+    start = perf_counter()
+    if sync:
+        blacklist_index.sync_index()
+    if (index := blacklist_index.get_index()) is None:
+        raise RuntimeError("Blacklist index is missing or stale, run without --no-sync")
+
+    records: dict[str, dict] = {}
+    query_users: dict[Platform, set[str]] = {}
+    for record in deta_api.iter_items(page_size):
+        if not record.get("verification_complete") or record.get("is_blacklisted"):
+            continue
+        records[record["key"]] = record
+        for query in blacklist_queries(record):
+            # Normalized so the same identifier of different users is only looked up once
+            query_users.setdefault(Platform(query.platform_type, str(query.value).lower()), set()).add(record["key"])
+
+    matches: dict[str, set[str]] = {}
+    for query, usernames in query_users.items():
+        if cards := index.search(query):
+            for username in usernames:
+                matches.setdefault(username, set()).update(card.short_url for card in cards)
+
+    logger.info(f"Screened {len(records)} users with {len(query_users)} unique identifiers in {perf_counter() - start:.2f}s, "
+                f"{len(matches)} blacklisted")
+    if dry_run:
+        return sorted(matches)
+
+    for username, blacklist_urls in matches.items():
+        # Only the flag is set, the record may have changed since it was streamed
+        deta_api.update_fields(username, {"is_blacklisted": True})
+        blacklist_urls = '\n'.join(sorted(blacklist_urls))
+        send_message_to_discord(f"Blacklisted u/{username} found while re-screening. See https://fallout76marketplace.com/user/{username}\n"
+                                f"Blacklist cards:\n{blacklist_urls}")
+    # The app's job workers aren't running in this process
+    logger.info(f"Ran {job_queue.drain()} queued jobs")
+    return sorted(matches)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-screen all verified users against the blacklist.")
+    parser.add_argument("--dry-run", action="store_true", help="only report blacklisted users")
+    parser.add_argument("--no-sync", action="store_true", help="use the blacklist mirror as it is")
+    parser.add_argument("--page-size", type=int, default=1000, help="records fetched per request")
+    args = parser.parse_args()
+    for username in rescreen(dry_run=args.dry_run, sync=not args.no_sync, page_size=args.page_size):
+        print(username)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+"""
+Registry of the small user lists behind profile badges, e.g. couriers, moderators and trusted traders.
+
+The lists are loaded once from the yaml file into frozensets. The file is only parsed again when its mtime changes, and
+at most every ROLES_CHECK_INTERVAL seconds. After a SIGHUP it is parsed again on the next lookup, once
+install_sighup_handler was called, which gunicorn.conf.py does for every worker. If the file can't be read or parsed the
+roles loaded last are kept.
+"""
+from __future__ import annotations
+
+import signal
+from os import getenv, stat
+from threading import Lock
+from time import monotonic
+
+import yaml
+
+from log_gen import create_logger
+
+ROLES_PATH = getenv('ROLES_PATH', "couriers.yaml")
+ROLES_CHECK_INTERVAL = float(getenv('ROLES_CHECK_INTERVAL', 5))
+
+logger = create_logger(__name__)
+
+
+class RoleRegistry:
+    """
+    Maps each role to the frozenset of lowercase usernames that have it.
+    """
+
+    def __init__(self, path: str, check_interval: float = ROLES_CHECK_INTERVAL):
+        self.path = path
+        self.check_interval = check_interval
+        self._roles: dict[str, frozenset[str]] = {}
+        self._mtime = None
+        self._next_check = 0.0
+        self._reload_requested = False
+        self._lock = Lock()
+        self.reload()
+
+    def reload(self) -> None:
+        """
+        Parses the file again, keeping the current roles if it can't be read or parsed.
+        """
+        with self._lock:
+            self._next_check = monotonic() + self.check_interval
+            try:
+                mtime = stat(self.path).st_mtime
+                with open(self.path, 'r') as fp:
+                    roles = yaml.safe_load(fp) or {}
+                self._roles = {role: frozenset(str(username).lower() for username in usernames or []) for role, usernames in roles.items()}
+            except (OSError, yaml.YAMLError, AttributeError, TypeError) as e:
+                logger.error(f"Could not load the roles from {self.path}, keeping the roles loaded last: {e}")
+                return
+            self._mtime = mtime
+
+    def request_reload(self) -> None:
+        """
+        Makes the next lookup parse the file again. Safe to call from a signal handler, unlike reload which takes a lock
+        the interrupted thread could be holding.
+        """
+        self._reload_requested = True
+
+    def _reload_if_changed(self) -> None:
+        if self._reload_requested:
+            self._reload_requested = False
+            self.reload()
+            return
+        if monotonic() < self._next_check:
+            return
+        self._next_check = monotonic() + self.check_interval
+        try:
+            mtime = stat(self.path).st_mtime
+        except OSError:
+            # e.g. while the file is being replaced, the roles loaded last stay in use
+            return
+        if mtime != self._mtime:
+            self.reload()
+
+    def members(self, role: str) -> frozenset[str]:
+        """
+        :param role: Role name, a top level key of the file
+        :return: Usernames that have the role
+        """
+        self._reload_if_changed()
+        return self._roles.get(role, frozenset())
+
+    def has_role(self, role: str, username: str) -> bool:
+        """
+        :param role: Role name, a top level key of the file
+        :param username: Reddit username
+        :return: True if the user has the role
+        """
+        return username.lower() in self.members(role)
+
+
+registry = RoleRegistry(ROLES_PATH)
+
+
+def install_sighup_handler() -> None:
+    """
+    Reloads the registry on the next lookup after the process gets SIGHUP. Has to be called from the main thread.
+    """
+    signal.signal(signal.SIGHUP, lambda signum, frame: registry.request_reload())
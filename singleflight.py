@@ -0,0 +1,73 @@
+"""
+Collapses concurrent identical calls within a worker into one.
+
+When many visitors open the same profile at once, the first request makes the upstream call and the others wait for
+its result instead of making the same call again.
+"""
+from __future__ import annotations
+
+from threading import Event, Lock
+from typing import Any, Callable, Hashable, Optional
+
+import metrics
+
+
+class _Call:
+    def __init__(self):
+        self.done = Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+
+
+class SingleFlight:
+    """
+    Runs at most one call per key at a time. Callers arriving while a call with their key is in flight get its result,
+    or its exception.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._calls: dict[Hashable, _Call] = {}
+        self._lock = Lock()
+
+    def do(self, key: Hashable, fn: Callable, *args, **kwargs) -> Any:
+        """
+        Calls fn, or waits for the call with the same key that is already in flight.
+
+        :param key: Key identifying the call, e.g. the username looked up
+        :param fn: Function to call
+        :return: Result of the call
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = self._calls[key] = _Call()
+        if not is_leader:
+            metrics.incr(f"singleflight_collapsed_total{{name=\"{self.name}\"}}")
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        metrics.incr(f"singleflight_calls_total{{name=\"{self.name}\"}}")
+        try:
+            call.result = fn(*args, **kwargs)
+            return call.result
+        except BaseException as err:
+            call.error = err
+            raise
+        finally:
+            with self._lock:
+                if self._calls.get(key) is call:
+                    del self._calls[key]
+            call.done.set()
+
+    def forget(self, key: Hashable) -> None:
+        """
+        Makes callers arriving from now on start a new call instead of waiting for the one in flight, e.g. because the
+        record it is reading was just written.
+
+        :param key: Key identifying the call
+        """
+        with self._lock:
+            self._calls.pop(key, None)
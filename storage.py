@@ -0,0 +1,223 @@
+"""
+Storage interface used by deta_api, and a local SQLite implementation of it.
+
+The records are stored as json. The SQLite engine indexes the key and the platform id fields so lookups by any of them
+are point lookups.
+"""
+from __future__ import annotations
+
+import json
+import re
+import sqlite3
+from abc import ABC, abstractmethod
+from threading import local
+from typing import Iterator, Optional
+
+from deta.base import FetchResponse
+
+INDEXED_FIELDS = ("XBOX_ID", "PlayStation_ID")
+REGEX_FIELD_NAME = re.compile(r"^[\w ]+$")
+
+
+class StorageError(Exception):
+    """
+    Raised the same way by every backend when an operation is refused because of the stored items.
+    """
+
+
+class ItemExistsError(StorageError):
+    """
+    Raised by insert if an item with the key already exists.
+    """
+
+
+class ItemNotFoundError(StorageError):
+    """
+    Raised by update if no item has the key.
+    """
+
+
+class StorageBackend(ABC):
+    """
+    Key value store of json records with the operations the app uses from Deta Base.
+    """
+
+    @abstractmethod
+    def get(self, key: str) -> Optional[dict]:
+        """
+        Gets a single item by its key
+
+        :param key: Key of the item
+        :return: The item or None if it doesn't exist
+        """
+
+    @abstractmethod
+    def fetch(self, query: dict | list, *, limit: int = 1000, last: Optional[str] = None) -> FetchResponse:
+        """
+        Fetches the items matching the query. Only equality conditions are supported, a list of conditions matches items
+        matching any of them.
+
+        :param query: Deta Base query
+        :param limit: Maximum number of items in one page
+        :param last: Key of the last item of the previous page
+        :return: FetchResponse with the items
+        :raises ValueError: If the query has a condition other than equality
+        """
+
+    @abstractmethod
+    def insert(self, data: dict) -> dict:
+        """
+        Inserts an item, fails if an item with the same key already exists
+
+        :param data: Item to insert
+        :return: The inserted item
+        :raises ItemExistsError: If an item with the same key already exists
+        """
+
+    @abstractmethod
+    def put(self, data: dict, key: Optional[str] = None) -> dict:
+        """
+        Inserts or overwrites an item
+
+        :param data: Item to store
+        :param key: Key of the item, takes precedence over the key in data
+        :return: The stored item
+        """
+
+    @abstractmethod
+    def update(self, key: str, set_fields: dict) -> None:
+        """
+        Sets some fields of an existing item without touching the others
+
+        :param key: Key of the item
+        :param set_fields: Fields to set
+        :raises ItemNotFoundError: If the item doesn't exist
+        """
+
+    @abstractmethod
+    def put_many(self, items: list[dict]) -> None:
+        """
+        Inserts or overwrites the items
+
+        :param items: Items to store, each with its key
+        """
+
+    @abstractmethod
+    def delete(self, key: str) -> None:
+        """
+        Deletes an item, does nothing if it doesn't exist
+
+        :param key: Key of the item
+        """
+
+    def iter_items(self, page_size: int = 1000) -> Iterator[dict]:
+        """
+        Streams all the items page by page.
+
+        :param page_size: Number of items fetched per request
+        :return: Iterator over the items
+        """
+        last = None
+        while True:
+            fetch_res = self.fetch([], limit=page_size, last=last)
+            yield from fetch_res.items
+            if not (last := fetch_res.last):
+                break
+
+
+class SQLiteBase(StorageBackend):
+    """
+    Storage backend keeping the items of one base in a table of a local SQLite database in WAL mode.
+    """
+
+    def __init__(self, name: str, path: str):
+        if not REGEX_FIELD_NAME.match(name):
+            raise ValueError(f"Invalid base name {name}")
+        self.table = name
+        self.path = path
+        self._local = local()
+        conn = self._connection()
+        conn.execute(f'CREATE TABLE IF NOT EXISTS "{self.table}" (key TEXT PRIMARY KEY, data TEXT NOT NULL)')
+        for field in INDEXED_FIELDS:
+            conn.execute(f'CREATE INDEX IF NOT EXISTS "{self.table}_{field}" ON "{self.table}" (json_extract(data, \'$."{field}"\'))')
+
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite3 connections can't be shared between threads
+        if getattr(self._local, "conn", None) is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return self._local.conn
+
+    def get(self, key: str) -> Optional[dict]:
+        row = self._connection().execute(f'SELECT data FROM "{self.table}" WHERE key = ?', (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def fetch(self, query: dict | list, *, limit: int = 1000, last: Optional[str] = None) -> FetchResponse:
+        conditions = query if isinstance(query, list) else [query]
+        where = []
+        params = []
+        or_clauses = []
+        for condition in conditions:
+            and_clauses = []
+            for field, value in condition.items():
+                if not REGEX_FIELD_NAME.match(field):
+                    raise ValueError(f"Only equality queries are supported, got {field}")
+                if field == "key":
+                    and_clauses.append("key = ?")
+                else:
+                    and_clauses.append(f"json_extract(data, '$.\"{field}\"') = ?")
+                params.append(value)
+            if and_clauses:
+                or_clauses.append(" AND ".join(and_clauses))
+        if or_clauses:
+            where.append(f"({' OR '.join(or_clauses)})")
+        if last:
+            where.append("key > ?")
+            params.append(last)
+        sql = f'SELECT key, data FROM "{self.table}"'
+        if where:
+            sql += f" WHERE {' AND '.join(where)}"
+        rows = self._connection().execute(f"{sql} ORDER BY key LIMIT ?", (*params, limit + 1)).fetchall()
+        items = [json.loads(row[1]) for row in rows[:limit]]
+        return FetchResponse(len(items), rows[limit - 1][0] if len(rows) > limit else None, items)
+
+    def insert(self, data: dict) -> dict:
+        try:
+            self._connection().execute(f'INSERT INTO "{self.table}" (key, data) VALUES (?, ?)', (data["key"], json.dumps(data)))
+        except sqlite3.IntegrityError as err:
+            raise ItemExistsError(data["key"]) from err
+        return data
+
+    def put(self, data: dict, key: Optional[str] = None) -> dict:
+        item = data | {"key": key} if key else data
+        self._connection().execute(f'INSERT OR REPLACE INTO "{self.table}" (key, data) VALUES (?, ?)', (item["key"], json.dumps(item)))
+        return item
+
+    def update(self, key: str, set_fields: dict) -> None:
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(f'SELECT data FROM "{self.table}" WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                raise ItemNotFoundError(key)
+            conn.execute(f'UPDATE "{self.table}" SET data = ? WHERE key = ?', (json.dumps(json.loads(row[0]) | set_fields), key))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def put_many(self, items: list[dict]) -> None:
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany(f'INSERT OR REPLACE INTO "{self.table}" (key, data) VALUES (?, ?)',
+                             [(item["key"], json.dumps(item)) for item in items])
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def delete(self, key: str) -> None:
+        self._connection().execute(f'DELETE FROM "{self.table}" WHERE key = ?', (key,))
@@ -0,0 +1,111 @@
+"""
+In-memory stand-in for the Deta Base HTTP API, for running the app and the batch jobs locally.
+
+Usage: python stubs/deta_base.py [port]
+then point the app at it with DETA_BASE_URL=http://127.0.0.1:<port>/v1 and any DETA_PROJECT_KEY like "local_key".
+"""
+from __future__ import annotations
+
+import json
+import sys
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock
+from urllib.parse import unquote
+
+_bases: dict[str, dict[str, dict]] = {}
+_lock = Lock()
+
+
+def _matches(item: dict, query: list[dict]) -> bool:
+    if not query:
+        return True
+    return any(all(item.get(field) == value for field, value in condition.items()) for condition in query)
+
+
+class DetaBaseHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status: int, body: dict):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _route(self) -> tuple[dict, str, str]:
+        # /v1/{project_id}/{base_name}/{rest}
+        parts = self.path.split("/", 4)
+        with _lock:
+            base = _bases.setdefault(f"{parts[2]}/{parts[3]}", {})
+        return base, parts[4].split("/")[0], unquote(parts[4].split("/", 1)[1]) if "/" in parts[4] else ""
+
+    def _body(self) -> dict:
+        length = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(length)) if length else {}
+
+    def do_GET(self):
+        base, _, key = self._route()
+        with _lock:
+            item = base.get(key)
+        self._send(200, item) if item else self._send(404, {"key": key})
+
+    def do_PUT(self):
+        base, _, _ = self._route()
+        items = self._body().get("items", [])
+        with _lock:
+            for item in items:
+                base[item["key"]] = item
+        self._send(207, {"processed": {"items": items}})
+
+    def do_POST(self):
+        base, resource, _ = self._route()
+        body = self._body()
+        if resource == "query":
+            with _lock:
+                keys = sorted(base)
+                if body.get("last"):
+                    keys = [key for key in keys if key > body["last"]]
+                matched = [base[key] for key in keys if _matches(base[key], body.get("query", []))]
+            page = matched[:body.get("limit", 1000)]
+            last = page[-1]["key"] if len(matched) > len(page) else None
+            self._send(200, {"paging": {"size": len(page), "last": last}, "items": page})
+            return
+        item = body["item"]
+        with _lock:
+            if item["key"] in base:
+                self._send(409, {"errors": ["Conflict"]})
+                return
+            base[item["key"]] = item
+        self._send(201, item)
+
+    def do_PATCH(self):
+        base, _, key = self._route()
+        body = self._body()
+        with _lock:
+            if key not in base:
+                self._send(404, {"key": key})
+                return
+            base[key] |= body.get("set", {})
+            for field in body.get("delete", []):
+                base[key].pop(field, None)
+            item = base[key]
+        self._send(200, item)
+
+    def do_DELETE(self):
+        base, _, key = self._route()
+        with _lock:
+            base.pop(key, None)
+        self._send(200, {"key": key})
+
+
+def serve(port: int = 8001) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer(("127.0.0.1", port), DetaBaseHandler)
+    return server
+
+
+if __name__ == '__main__':
+    serve(int(sys.argv[1]) if len(sys.argv) > 1 else 8001).serve_forever()
@@ -0,0 +1,62 @@
+"""
+Stand-in for the parts of the Reddit API the app calls, for load tests and running the app locally.
+
+Usage: python stubs/reddit.py [port] [latency]
+then point the app at it with REDDIT_URL and REDDIT_OAUTH_URL set to http://127.0.0.1:<port>. Every response is delayed
+by latency seconds to simulate a slow upstream.
+"""
+from __future__ import annotations
+
+import json
+import sys
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import sleep
+from urllib.parse import parse_qs, urlsplit
+
+
+class RedditHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status: int, body: dict):
+        sleep(self.server.latency)
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if urlsplit(self.path).path == "/api/v1/access_token":
+            self._send(200, {"access_token": "local_access_token", "refresh_token": "local_refresh_token", "token_type": "bearer",
+                             "expires_in": 3600, "scope": "*"})
+        else:
+            self._send(404, {"error": 404, "message": "Not Found"})
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        parts = url.path.strip("/").split("/")
+        if url.path == "/api/v1/me":
+            self._send(200, {"name": "local_user"})
+        elif len(parts) == 3 and parts[0] == "user" and parts[2] == "about.json":
+            self._send(200, {"kind": "t2", "data": {"name": parts[1], "icon_img": "https://styles.redditmedia.com/avatar.png?width=256",
+                                                    "total_karma": 12345, "subreddit": {"over_18": False}}})
+        elif len(parts) == 4 and parts[0] == "r" and parts[2:] == ["api", "flairlist"]:
+            name = parse_qs(url.query).get("name", ["local_user"])[0]
+            self._send(200, {"users": [{"user": name, "flair_text": "Karma: 42", "flair_css_class": None}], "next": None, "prev": None})
+        else:
+            self._send(404, {"error": 404, "message": "Not Found"})
+
+
+def serve(port: int = 8002, latency: float = 0) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer(("127.0.0.1", port), RedditHandler)
+    server.latency = latency
+    return server
+
+
+if __name__ == '__main__':
+    serve(int(sys.argv[1]) if len(sys.argv) > 1 else 8002, float(sys.argv[2]) if len(sys.argv) > 2 else 0).serve_forever()
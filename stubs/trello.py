@@ -0,0 +1,89 @@
+"""
+In-memory stand-in for the parts of the Trello API the blacklist mirror syncs from, for running the batch jobs locally.
+
+Usage: python stubs/trello.py [port] [cards.json]
+then point the app at it with TRELLO_API_URL=http://127.0.0.1:<port>/1. cards.json maps board ids to lists of cards with
+name, desc and optionally id, closed, labels and shortUrl. put_card adds or changes a card and bumps its
+dateLastActivity, so an incremental sync picks it up.
+"""
+from __future__ import annotations
+
+import json
+import sys
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import count
+from threading import Lock
+from urllib.parse import parse_qs, urlsplit
+
+_boards: dict[str, dict[str, dict]] = {}
+_ids = count(1)
+_lock = Lock()
+
+
+def put_card(board: str, card: dict) -> dict:
+    """
+    Adds a card to a board, or changes the card with the same id.
+
+    :param board: Board id, e.g. one of trello_api.BLACKLIST_BOARDS
+    :param card: Card fields, at least name and desc
+    :return: The stored card
+    """
+    with _lock:
+        card_id = card.get("id") or f"card{next(_ids):08d}"
+        stored = {"closed": False, "labels": [], "shortUrl": f"https://trello.com/c/{card_id}"} | card | {
+            "id": card_id,
+            "dateLastActivity": datetime.now(timezone.utc).isoformat(timespec="microseconds").replace("+00:00", "Z"),
+        }
+        _boards.setdefault(board, {})[card_id] = stored
+    return stored
+
+
+def _select(card: dict, fields: str | None) -> dict:
+    if not fields or fields == "all":
+        return dict(card)
+    return {"id": card["id"]} | {field: card[field] for field in fields.split(",") if field in card}
+
+
+class TrelloHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status: int, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        fields = parse_qs(url.query).get("fields", [None])[0]
+        # /1/boards/{board}/cards/all or /1/cards/{card}
+        parts = url.path.strip("/").split("/")
+        with _lock:
+            if parts[1:2] == ["boards"] and parts[3:] in (["cards"], ["cards", "all"]):
+                self._send(200, [_select(card, fields) for card in _boards.get(parts[2], {}).values()])
+                return
+            if parts[1:2] == ["cards"] and len(parts) == 3:
+                for cards in _boards.values():
+                    if (card := cards.get(parts[2])) is not None:
+                        self._send(200, _select(card, fields))
+                        return
+        self._send(404, {"message": "The requested resource was not found."})
+
+
+def serve(port: int = 8003, cards_path: str | None = None) -> ThreadingHTTPServer:
+    if cards_path:
+        with open(cards_path) as fp:
+            for board, cards in json.load(fp).items():
+                for card in cards:
+                    put_card(board, card)
+    return ThreadingHTTPServer(("127.0.0.1", port), TrelloHandler)
+
+
+if __name__ == '__main__':
+    serve(int(sys.argv[1]) if len(sys.argv) > 1 else 8003, sys.argv[2] if len(sys.argv) > 2 else None).serve_forever()
@@ -0,0 +1,116 @@
+"""
+Timing spans of outbound calls, tied to the request that made them.
+
+Every call to Reddit, PRAW, Deta, xbl.io, PSN, Trello and Discord is recorded in the upstream_request_seconds histogram
+labelled with the upstream and the Flask endpoint of the request, or "background" outside of a request. The spans of a
+request are also summed per upstream into its Server-Timing header, and the request itself is recorded in the
+http_request_seconds histogram.
+
+The current request is kept in a context variable, so work handed to an executor has to be submitted with submit to be
+attributed to it.
+"""
+from __future__ import annotations
+
+from collections import defaultdict
+from concurrent.futures import Executor, Future
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
+from threading import Lock
+from time import perf_counter
+from typing import Callable, Iterator, Optional
+
+from requests.adapters import HTTPAdapter
+
+import metrics
+
+
+class RequestTrace:
+    """
+    Spans of one request.
+    """
+
+    def __init__(self, endpoint: str):
+        self.endpoint = endpoint
+        self.start = perf_counter()
+        self.upstream_seconds: defaultdict[str, float] = defaultdict(float)
+        # Spans can end in executor threads
+        self._lock = Lock()
+
+    def add(self, upstream: str, seconds: float) -> None:
+        with self._lock:
+            self.upstream_seconds[upstream] += seconds
+
+
+_current: ContextVar[Optional[RequestTrace]] = ContextVar("request_trace", default=None)
+
+
+def start_request(endpoint: Optional[str]) -> None:
+    """
+    Starts the trace of a request.
+
+    :param endpoint: Flask endpoint of the request, None if no route matched
+    """
+    _current.set(RequestTrace(endpoint or "unmatched"))
+
+
+def add_server_timing(response):
+    """
+    Adds the time spent per upstream to the response as a Server-Timing header.
+
+    :param response: Flask response
+    :return: The same response
+    """
+    if (trace := _current.get()) is not None and trace.upstream_seconds:
+        response.headers["Server-Timing"] = ", ".join(f"{upstream};dur={seconds * 1000:.1f}" for upstream, seconds in trace.upstream_seconds.items())
+    return response
+
+
+def end_request(error: Optional[BaseException] = None) -> None:
+    """
+    Records the duration of the request and ends its trace. Registered as a teardown so the writes of the unit of work
+    are part of it.
+    """
+    if (trace := _current.get()) is not None:
+        metrics.observe("http_request_seconds", perf_counter() - trace.start, {"endpoint": trace.endpoint})
+        _current.set(None)
+
+
+@contextmanager
+def span(upstream: str) -> Iterator[None]:
+    """
+    Times the outbound call in the with block.
+
+    :param upstream: Name of the upstream, e.g. reddit
+    """
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        seconds = perf_counter() - start
+        trace = _current.get()
+        metrics.observe("upstream_request_seconds", seconds, {"upstream": upstream, "endpoint": trace.endpoint if trace else "background"})
+        if trace is not None:
+            trace.add(upstream, seconds)
+
+
+def submit(executor: Executor, fn: Callable, *args, **kwargs) -> Future:
+    """
+    Submits the call to the executor so that the spans it records belong to the current request.
+
+    :return: Future of the call
+    """
+    return executor.submit(copy_context().run, fn, *args, **kwargs)
+
+
+class TracedHTTPAdapter(HTTPAdapter):
+    """
+    Adapter that records a span for every request sent through it.
+    """
+
+    def __init__(self, upstream: str, **kwargs):
+        self.upstream = upstream
+        super().__init__(**kwargs)
+
+    def send(self, *args, **kwargs):
+        with span(self.upstream):
+            return super().send(*args, **kwargs)
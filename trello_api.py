@@ -1,14 +1,50 @@
 import re
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from os import getenv
-from typing import TYPE_CHECKING
+from threading import Lock
+from typing import TYPE_CHECKING, Optional
 
+import requests
 from trello import TrelloClient, Card
 
+import tracing
+
 if TYPE_CHECKING:
     from user_verification import Platform
 
 REGEX_REMOVE_PARENTHESIS = re.compile(r"\(.+\)")
-REGEX_MATCH_FIELD_CONTENT = re.compile(r"(?<=:).+$", re.MULTILINE)
+BLACKLIST_BOARDS = ("0eCDKYHr", "8oCsXC2j")  # Market76 Blacklist and Fallout76Marketplace Blacklist
+TRELLO_SEARCH_WORKERS = int(getenv('TRELLO_SEARCH_WORKERS', 6))
+GUNICORN_THREADS = int(getenv('GUNICORN_THREADS', 1))
+TRELLO_DEFAULT_API_URL = "https://api.trello.com/1"
+# py-trello always calls api.trello.com, set this to send its requests elsewhere, e.g. to stubs/trello.py
+TRELLO_API_URL = getenv('TRELLO_API_URL', TRELLO_DEFAULT_API_URL)
+
+_trello_client: Optional[TrelloClient] = None
+_board_ids: Optional[list[str]] = None
+_client_lock = Lock()
+_executor = ThreadPoolExecutor(max_workers=TRELLO_SEARCH_WORKERS, thread_name_prefix="trello_api")
+
+
+@lru_cache(maxsize=4096)
+def description_identifiers(desc: str) -> frozenset[str]:
+    """
+    Normalizes a card description into the set of identifiers it lists. The result is cached so a card that shows up in
+    the results of several queries is only normalized once.
+
+    :param desc: card description
+    :return: Set of lowercase identifiers
+    """
+    identifiers = set()
+    for line in REGEX_REMOVE_PARENTHESIS.sub("", desc).splitlines():
+        line = line.strip().replace("\\", "").replace("u/", "").lower()
+        # If line has a colon we are only interested the content after it. E.g. XBL: Test
+        if ':' in line:
+            line = line.partition(':')[2].strip()
+        if line:
+            identifiers.add(line)
+    return frozenset(identifiers)
 
 
 def is_in_description(desc: str, search_query: str):
@@ -19,16 +55,26 @@ def is_in_description(desc: str, search_query: str):
     :param search_query: search query input
     :return: True if search query exists in card description otherwise false
     """
-    new_desc = re.sub(REGEX_REMOVE_PARENTHESIS, "", desc).splitlines()
-    all_lines = [line for line in new_desc if line]  # Removes all empty lines
-    all_lines = map(lambda element: element.strip().replace("\\", "").replace("u/", "").lower(), all_lines)
-    for line in all_lines:
-        # If line has a colon we are only interested the content after it. E.g. XBL: Test
-        if ':' in line:
-            line = re.search(REGEX_MATCH_FIELD_CONTENT, line).group().strip()
-        if search_query.lower() == line:
-            return True
-    return False
+    return search_query.lower() in description_identifiers(desc)
+
+
+def is_scammer_card(card: Card, search_query: "Platform") -> bool:
+    """
+    Checks if a card is an active scammer card for the platform of the query that really lists the query
+
+    :param card: Trello card
+    :param search_query: search query input
+    :return: True if the card matches
+    """
+    # closed means the card is archived
+    if card.closed:
+        return False
+    # Remove cards that are from other platforms
+    if search_query.platform_type != "Reddit" and search_query.platform_type not in card.name.upper():
+        return False
+    if not is_in_description(card.desc, search_query.value):
+        return False
+    return any(label.name.lower() == 'scamming' for label in card.labels)
 
 
 def filter_search_result(search_result: list[Card], search_query: "Platform") -> list[Card]:
@@ -38,28 +84,53 @@ def filter_search_result(search_result: list[Card], search_query: "Platform") ->
     :param search_query:
     :return:
     """
-    for card in search_result.copy():
-        # closed means the card is archived
-        if card.closed:
-            search_result.remove(card)
-            continue
-
-        # Remove cards that are from other platforms
-        if search_query.platform_type != "Reddit":
-            if search_query.platform_type not in card.name.upper():
-                search_result.remove(card)
-                continue
-
-        if not is_in_description(card.desc, search_query.value):
-            search_result.remove(card)
-            continue
-
-        for label in card.labels:
-            if label.name.lower() == 'scamming':
-                break
-        else:
-            search_result.remove(card)
-    return search_result
+    return [card for card in search_result if is_scammer_card(card, search_query)]
+
+
+class _RebasedHTTPAdapter(tracing.TracedHTTPAdapter):
+    """
+    Sends the requests made to the Trello API to TRELLO_API_URL instead.
+    """
+
+    def send(self, request, *args, **kwargs):
+        if request.url.startswith(TRELLO_DEFAULT_API_URL):
+            request.url = TRELLO_API_URL.rstrip("/") + request.url[len(TRELLO_DEFAULT_API_URL):]
+        return super().send(request, *args, **kwargs)
+
+
+def get_trello_client() -> TrelloClient:
+    """
+    Gets the client shared by the whole process. It uses a pooled session so concurrent searches reuse connections.
+
+    :return: TrelloClient
+    """
+    global _trello_client
+    if _trello_client is None:
+        with _client_lock:
+            if _trello_client is None:
+                http_session = requests.Session()
+                http_session.mount("https://", tracing.TracedHTTPAdapter("trello", pool_maxsize=TRELLO_SEARCH_WORKERS + GUNICORN_THREADS))
+                if TRELLO_API_URL != TRELLO_DEFAULT_API_URL:
+                    http_session.mount(TRELLO_DEFAULT_API_URL, _RebasedHTTPAdapter("trello"))
+                _trello_client = TrelloClient(
+                    api_key=getenv('TRELLO_API_KEY'),
+                    api_secret=getenv('TRELLO_TOKEN'),
+                    http_service=http_session,
+                )
+    return _trello_client
+
+
+def get_blacklist_board_ids() -> list[str]:
+    """
+    Resolves the ids of the blacklist boards once and caches them since they never change.
+
+    :return: List of board ids
+    """
+    global _board_ids
+    if _board_ids is None:
+        trello_client = get_trello_client()
+        _board_ids = [trello_client.get_board(board).id for board in BLACKLIST_BOARDS]
+    return _board_ids
 
 
 def search_in_blacklist(search_query: "Platform") -> list[Card]:
@@ -69,26 +140,21 @@ def search_in_blacklist(search_query: "Platform") -> list[Card]:
     :param search_query: Search Query
     :return: List of cards containing that query
     """
-    trello_client = TrelloClient(
-        api_key=getenv('TRELLO_API_KEY'),
-        api_secret=getenv('TRELLO_TOKEN'),
-    )
-    m76_board = trello_client.get_board("0eCDKYHr")
-    fo76_board = trello_client.get_board("8oCsXC2j")
-    search_result = trello_client.search(query=search_query.value, board_ids=[m76_board.id, fo76_board.id], models=['cards'], cards_limit=1000)
+    trello_client = get_trello_client()
+    search_result = trello_client.search(query=search_query.value, board_ids=get_blacklist_board_ids(), models=['cards'], cards_limit=1000)
     search_result = filter_search_result(search_result=search_result, search_query=search_query)
     return search_result
 
 
 def search_multiple_items_blacklist(search_queries: list["Platform"]) -> list[Card]:
     """
-    Checks if any item provided in search queries exist in blacklist
+    Checks if any item provided in search queries exist in blacklist. The queries are searched concurrently.
 
     :param search_queries: List of queries
     :return: True if even one query exists else false
     """
+    get_blacklist_board_ids()  # Resolved before fanning out so the queries don't all resolve it at once
     result = []
-    for query in search_queries:
-        cards = search_in_blacklist(query)
+    for cards in _executor.map(search_in_blacklist, search_queries):
         result.extend(cards)
     return list(set(result))
@@ -1,22 +1,24 @@
-import json
-from contextlib import suppress
-from os import getenv
 from random import randint
-from threading import Thread
 from typing import NamedTuple, Optional
 
 import requests
 from flask import render_template, Blueprint, request, session, redirect, url_for
-from psnawp_api import PSNAWP
 from psnawp_api.core.psnawp_exceptions import PSNAWPNotFound, PSNAWPAuthenticationError, PSNAWPForbidden, PSNAWPBadRequest, PSNAWPException
 from requests import HTTPError
 
+import blacklist_index
 import deta_api
+import discord_api
+import job_queue
+import psn_api
+import xbox_api
 from log_gen import create_logger
 from trello_api import search_multiple_items_blacklist
 
 user_verification = Blueprint("user_verification", __name__)
 logger = create_logger(__name__)
+# Fields of a user record the blacklist is searched for
+BLACKLIST_FIELDS = ("key", "Fallout 76", "PlayStation", "PlayStation_ID", "XBOX", "XBOX_ID")
 
 
 class Platform(NamedTuple):
@@ -32,43 +34,66 @@ def back_btn_or_direct_link():
 
 def send_message_to_discord(msg):
     """
-    Sends the message to discord channel via webhook url.
+    Queues the message to be sent to discord channel. It is held back for a moment so the messages queued around the
+    same time are sent together.
 
     :param msg: message content.
     """
+    job_queue.enqueue("discord_message", msg, delay=discord_api.DISCORD_COALESCE_WINDOW)
 
-    webhook = getenv("USER_VERIFICATION_CHANNEL")
-    data = {"content": msg, "username": "User Verification"}
-    with suppress(Exception):
-        requests.post(webhook, data=json.dumps(data), headers={"Content-Type": "application/json"})
+
+@job_queue.handler("discord_message", batch_size=discord_api.DISCORD_BATCH_SIZE)
+def post_messages_to_discord(messages: list[str]):
+    """
+    Sends the queued messages to discord channel via webhook url. The jobs are only removed from the queue once this
+    returns, and retried if it raises.
+
+    :param messages: message contents.
+    """
+    discord_api.webhook.send(messages)
+
+
+def blacklist_queries(user_data: dict) -> list[Platform]:
+    """
+    Builds the blacklist search queries for all the identifiers of a user.
+
+    :param user_data: User record
+    :return: List of queries
+    """
+    queries: list[Platform] = [Platform("Reddit", user_data['key']),
+                               Platform("PC", user_data.get('Fallout 76')),
+                               Platform("PS4", user_data.get('PlayStation')),
+                               Platform("PS4", user_data.get('PlayStation_ID')),
+                               Platform("XB1", user_data.get('XBOX')),
+                               Platform("XB1", user_data.get('XBOX_ID'))]
+    return [query for query in queries if query.value is not None]
 
 
+@job_queue.handler("check_blacklist")
 def check_user_in_blacklist(updated_data: dict):
-    user_data: list[Platform] = [Platform("Reddit", updated_data['key']),
-                                 Platform("PC", updated_data.get('Fallout 76')),
-                                 Platform("PS4", updated_data.get('PlayStation')),
-                                 Platform("PS4", updated_data.get('PlayStation_ID')),
-                                 Platform("XB1", updated_data.get('XBOX')),
-                                 Platform("XB1", updated_data.get('XBOX_ID'))]
-    result = search_multiple_items_blacklist([data for data in user_data if data.value is not None])
+    search_queries = blacklist_queries(updated_data)
+    # The local mirror answers with one dict lookup per identifier, Trello is only searched if the mirror is stale
+    if (index := blacklist_index.get_index()) is not None:
+        result = index.search_many(search_queries)
+    else:
+        result = search_multiple_items_blacklist(search_queries)
     if result:
         blacklist_urls = '\n'.join([x.short_url for x in result])
         msg = f"Blacklisted u/{updated_data['key']} registered. See https://fallout76marketplace.com/user/{updated_data['key']}\n" \
               f"Blacklist cards:\n{blacklist_urls}"
         send_message_to_discord(msg)
 
-        updated_data["is_blacklisted"] = True
-        deta_api.update_item(updated_data, updated_data['key'])
+        deta_api.update_fields(updated_data['key'], {"is_blacklisted": True})
 
 
 def add_gamer_tag_to_db(*, verification_complete, check_blacklist: bool = False):
-    updated_data = deta_api.get_item(session['username']).items[0]
+    changes = {"verification_complete": verification_complete, session['platform']: session['gt'], f"{session['platform']}_ID": session['gt_id']}
+    deta_api.stage_update(session['username'], changes)
     if check_blacklist:
-        black_list_check_thread = Thread(target=check_user_in_blacklist, args=(updated_data,))
-        black_list_check_thread.daemon = True
-        black_list_check_thread.start()
-    updated_data |= {"verification_complete": verification_complete, session['platform']: session['gt'], f"{session['platform']}_ID": session['gt_id']}
-    deta_api.update_item(updated_data, session['username'])
+        updated_data = deta_api.get_item(session['username']).items[0]
+        # The payload is stored in plain text in the job queue, so it only gets the identifiers, not the tokens of the record
+        payload = {field: updated_data[field] for field in BLACKLIST_FIELDS if field in updated_data}
+        job_queue.enqueue("check_blacklist", payload, dedup_key=session['username'])
 
 
 @user_verification.route('/user_profile', methods=['POST'])
@@ -101,34 +126,13 @@ def verify_identity():
         return render_template("verification_code.html", platform=session['platform'], warning_message="Verification Code incorrect. Please try again.")
 
 
-def get_xuid(gamer_tag):
-    auth_headers = {"X-Authorization": getenv('XBOX_API'), "Content-Type": "application/json"}
-    params = {'gt': gamer_tag}
-    # Sometimes XBOX api returns empty results so have to try twice
-    try:
-        resp = requests.get('https://xbl.io/api/v2/friends/search', headers=auth_headers, params=params)
-        json_resp = resp.json()
-        logger.info(json_resp)
-        if json_resp.get('code') == 28:
-            raise HTTPError(json_resp.get('description'))
-        resp.raise_for_status()
-        profile_list = json_resp.get('profileUsers')[0]
-        return profile_list['settings'][2]['value'], profile_list['id']
-
-    except (requests.JSONDecodeError, KeyError, HTTPError) as err:
-        raise HTTPError(f"Could not find the GamerTag {gamer_tag}. Please check the spelling.") from err
-
-
 def send_message_xbox(gamer_tag):
-    gamer_tag, xuid = get_xuid(gamer_tag)
-    auth_headers = {"X-Authorization": getenv("XBOX_API"), "Content-Type": "application/json"}
+    gamer_tag, xuid = xbox_api.get_xuid(gamer_tag)
     verification_code = randint(100000, 999999)
     session['verification_code'] = verification_code
-    msg = json.dumps({"xuid": xuid, "message": f"Your verification code is {verification_code}. Please do not share this with anyone."})
     logger.info(f"{session['username']}, {gamer_tag} Verification Code {verification_code}")
     try:
-        resp = requests.post("https://xbl.io/api/v2/conversations", headers=auth_headers, data=msg)
-        resp.raise_for_status()
+        xbox_api.send_message(xuid, f"Your verification code is {verification_code}. Please do not share this with anyone.")
         session['gt'] = gamer_tag
         session['gt_id'] = xuid
     except requests.HTTPError as err:
@@ -137,12 +141,10 @@ def send_message_xbox(gamer_tag):
 
 def send_message_psnid(gamer_tag):
     try:
-        psnawp = PSNAWP(getenv('NPSSO'))
-        user = psnawp.user(online_id=gamer_tag)
-        group = psnawp.group(users_list=[user])
+        user = psn_api.get_user(online_id=gamer_tag)
         verification_code = randint(100000, 999999)
         session['verification_code'] = verification_code
-        group.send_message(f"Your verification code is {verification_code}. Please do not share this with anyone.")
+        psn_api.send_message(user, f"Your verification code is {verification_code}. Please do not share this with anyone.")
         session['gt'] = user.online_id
         session['gt_id'] = user.account_id
         logger.info(f"{session['username']}, {user.online_id} Verification code {verification_code}")
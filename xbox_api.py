@@ -0,0 +1,100 @@
+from __future__ import annotations
+
+import json
+from os import getenv
+
+import requests
+from requests import HTTPError
+
+import cache
+import tracing
+from log_gen import create_logger
+
+XBOX_API_URL = getenv('XBOX_API_URL', "https://xbl.io/api/v2")
+# Sometimes XBOX api returns empty results so a lookup is tried this many times before the GamerTag counts as not found
+XBOX_LOOKUP_ATTEMPTS = int(getenv('XBOX_LOOKUP_ATTEMPTS', 2))
+XUID_CACHE_TTL = float(getenv('XUID_CACHE_TTL', 24 * 60 * 60))
+XUID_NOT_FOUND_TTL = float(getenv('XUID_NOT_FOUND_TTL', 5 * 60))
+
+logger = create_logger(__name__)
+_session = requests.Session()
+_session.mount("https://", tracing.TracedHTTPAdapter("xbox", pool_maxsize=max(10, int(getenv('GUNICORN_THREADS', 1)))))
+_xuid_cache = cache.create_cache("xuid", maxsize=int(getenv('XUID_CACHE_MAXSIZE', 4096)), ttl=XUID_CACHE_TTL)
+
+
+def _headers() -> dict:
+    return {"X-Authorization": getenv('XBOX_API'), "Content-Type": "application/json"}
+
+
+def _search_gamer_tag(gamer_tag: str) -> tuple[str, str] | None:
+    """
+    Searches the GamerTag, retrying when the api returns empty results
+
+    :param gamer_tag: XBOX GamerTag
+    :return: GamerTag with the correct capitalization and xuid, or None if it doesn't exist
+    :raises HTTPError: If an HTTP Error occurs
+    """
+    for _ in range(XBOX_LOOKUP_ATTEMPTS):
+        resp = _session.get(f'{XBOX_API_URL}/friends/search', headers=_headers(), params={'gt': gamer_tag}, timeout=10)
+        try:
+            json_resp = resp.json()
+        except requests.JSONDecodeError:
+            resp.raise_for_status()
+            continue
+        logger.info(json_resp)
+        if json_resp.get('code') == 28:
+            return None
+        resp.raise_for_status()
+        if profile_users := json_resp.get('profileUsers'):
+            return profile_users[0]['settings'][2]['value'], profile_users[0]['id']
+    return None
+
+
+def get_xuid(gamer_tag: str) -> tuple[str, str]:
+    """
+    Resolves the GamerTag to its xuid. Found and not found GamerTags are both cached so retries and typo corrections by
+    the same user don't repeat the lookup.
+
+    :param gamer_tag: XBOX GamerTag
+    :return: GamerTag with the correct capitalization and xuid
+    :raises HTTPError: If the GamerTag doesn't exist or an HTTP Error occurs
+    """
+    key = gamer_tag.lower()
+    if (cached := _xuid_cache.get(key)) is None:
+        try:
+            result = _search_gamer_tag(gamer_tag)
+        except (KeyError, IndexError, HTTPError) as err:
+            raise HTTPError(f"Could not find the GamerTag {gamer_tag}. Please check the spelling.") from err
+        cached = json.dumps(result)
+        _xuid_cache.set(key, cached, XUID_CACHE_TTL if result else XUID_NOT_FOUND_TTL)
+    if (result := json.loads(cached)) is None:
+        raise HTTPError(f"Could not find the GamerTag {gamer_tag}. Please check the spelling.")
+    return result[0], result[1]
+
+
+def xuid_to_gamer_tag(xuid: str) -> str:
+    """
+    Gets the current GamerTag of a xuid
+
+    :param xuid: XBOX user id
+    :return: GamerTag
+    :raises HTTPError: If an HTTP Error occurs
+    """
+    resp = _session.get(f'{XBOX_API_URL}/account/{xuid}', headers={"X-Authorization": getenv("XBOX_API")}, timeout=10)
+    resp.raise_for_status()
+    json_data = resp.json()
+    xbox_profile = json_data.get('profileUsers')[0]
+    gamer_tag = xbox_profile['settings'][2]['value']
+    return gamer_tag
+
+
+def send_message(xuid: str, message: str) -> None:
+    """
+    Sends a message to the xbox user
+
+    :param xuid: XBOX user id
+    :param message: message content
+    :raises HTTPError: If an HTTP Error occurs
+    """
+    resp = _session.post(f"{XBOX_API_URL}/conversations", headers=_headers(), data=json.dumps({"xuid": xuid, "message": message}), timeout=10)
+    resp.raise_for_status()